@@ -2,39 +2,37 @@
 
 import re
 import json
-import urllib.request
+import urllib.parse
+import http.client
 import configparser
 import os
 import collections
-import webbrowser
-import markdown
 import base64
 import argparse
 import html
 import time
 import socket
-import subprocess
 import logging
 import hashlib
-try:
-    import gooey
-    GOOEY = True
-except ModuleNotFoundError:
-    print("Gooey not installed, switching to cli...")
-    GOOEY = False
-
-logging.basicConfig(
-    filename='obsidian_to_anki_log.log',
-    level=logging.DEBUG,
-    format='%(asctime)s:::%(levelname)s:::%(funcName)s:::%(message)s'
-)
+import concurrent.futures
+import fnmatch
+import bisect
+# Heavier modules (markdown, gooey, webbrowser, subprocess) are imported
+# where they're first needed, so the script starts quickly.
 
 MEDIA = dict()
+LEDGER_UPDATES = dict()  # Media ledger entries changed while scanning
 
 ID_PREFIX = "ID: "
 TAG_PREFIX = "Tags: "
 TAG_SEP = " "
 Note_and_id = collections.namedtuple('Note_and_id', ['note', 'id'])
+Session = collections.namedtuple(
+    'Session', ['version', 'note_types', 'fields']
+)
+Token = collections.namedtuple(
+    'Token', ['kind', 'start', 'end', 'groups', 'group_end']
+)
 NOTE_DICT_TEMPLATE = {
     "deckName": "",
     "modelName": "",
@@ -63,18 +61,15 @@ DATA_PATH = os.path.expanduser(
     )
 )
 
-md_parser = markdown.Markdown(
-    extensions=[
-        'fenced_code',
-        'footnotes',
-        'md_in_html',
-        'tables',
-        'nl2br',
-        'sane_lists'
-    ]
+FORMAT_CACHE_PATH = os.path.expanduser(
+    os.path.join(
+        os.path.dirname(os.path.realpath(__file__)),
+        "obsidian_to_anki_format_cache.json"
+    )
 )
 
 ANKI_PORT = 8765
+ANKI_CONNECT_VERSION = 6
 
 ANKI_CLOZE_REGEXP = re.compile(r'{{c\d+::[\s\S]+?}}')
 
@@ -105,25 +100,27 @@ def write_safe(filename, contents):
         os.remove(filename + ".bak")
 
 
-def string_insert(string, position_inserts):
+def apply_edits(string, edits):
     """
-    Insert strings in position_inserts into string, at indices.
-
-    position_inserts will look like:
-    [(0, "hi"), (3, "hello"), (5, "beep")]
+    Apply all edits to string at once, building the result in one pass.
+
+    Each edit replaces string[start:end] with a replacement, with indices
+    into the original string. So inserts have start == end, and deletions
+    have an empty replacement. edits will look like:
+    [(0, 0, "hi"), (3, 7, ""), (9, 9, "beep")]
+    Edits are applied in order of start, and one that starts inside an
+    earlier edit's span is dropped.
     """
-    offset = 0
-    position_inserts = sorted(list(position_inserts))
-    for position, insert_str in position_inserts:
-        string = "".join(
-            [
-                string[:position + offset],
-                insert_str,
-                string[position + offset:]
-            ]
-        )
-        offset += len(insert_str)
-    return string
+    pieces = list()
+    position = 0
+    for start, end, replacement in sorted(edits):
+        if start < position:
+            continue
+        pieces.append(string[position:start])
+        pieces.append(replacement)
+        position = end
+    pieces.append(string[position:])
+    return "".join(pieces)
 
 
 def file_encode(filepath):
@@ -132,25 +129,203 @@ def file_encode(filepath):
         return base64.b64encode(f.read()).decode('utf-8')
 
 
+def file_hash(filepath):
+    """Get the sha256 hash of the file's contents, read in chunks."""
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
 def spans(pattern, string):
     """Return a list of span-tuples for matches of pattern in string."""
     return [match.span() for match in pattern.finditer(string)]
 
 
-def contained_in(span, spans):
-    """Return whether span is contained in spans (+- 1 leeway)"""
-    return any(
-        span[0] >= start - 1 and span[1] <= end + 1
-        for start, end in spans
+class SpanIndex:
+    """Sorted spans for checking whether a span is contained in any of them.
+
+    Spans nested inside another span are dropped, as they can never be
+    needed for a containment check. So both starts and ends are sorted,
+    and the only candidate for containing a span is the last one starting
+    at or before it - found by bisection.
+    """
+
+    def __init__(self, spans=()):
+        self.starts = list()
+        self.ends = list()
+        self.update(spans)
+
+    def contains(self, span, leeway=1):
+        """Return whether span is contained in a span (+- leeway)."""
+        index = bisect.bisect_right(self.starts, span[0] + leeway)
+        return index > 0 and self.ends[index - 1] >= span[1] - leeway
+
+    def add(self, span):
+        """Add span, keeping the spans sorted."""
+        start, end = span
+        if self.contains(span, leeway=0):
+            return
+        first = bisect.bisect_left(self.starts, start)
+        last = first
+        while last < len(self.ends) and self.ends[last] <= end:
+            last += 1  # Since these are nested inside span
+        self.starts[first:last] = [start]
+        self.ends[first:last] = [end]
+
+    def update(self, spans):
+        """Add all of spans."""
+        for span in spans:
+            self.add(span)
+
+
+def findignore(pattern, string, ignore_spans, variants=()):
+    """Yield all matches for pattern in string not in ignore_spans.
+
+    ignore_spans is a SpanIndex, and may have spans added while iterating.
+    Where pattern matches, the first of variants to match at the same
+    place is yielded instead, and the search carries on from its end.
+    """
+    position = 0
+    while position <= len(string):
+        match = pattern.search(string, position)
+        if match is None:
+            return
+        if not ignore_spans.contains(match.span()):
+            match = next(
+                (
+                    found for found in (
+                        variant.match(string, match.start())
+                        for variant in variants
+                    ) if found is not None
+                ),
+                match
+            )
+            yield match
+        position = max(match.end(), match.start() + 1)
+
+
+def occurrences(string, sub):
+    """Yield the index of every occurrence of sub in string."""
+    index = string.find(sub)
+    while index != -1:
+        yield index
+        index = string.find(sub, index + 1)
+
+
+def make_token(kind, match):
+    """Make a Token from a match, noting where its first group ends."""
+    return Token(
+        kind, match.start(), match.end(), match.groups(),
+        match.end(1) if match.re.groups else match.end()
+    )
+
+
+def tokenize(string):
+    """Walk string once, line by line, yielding Tokens for its syntax.
+
+    The kinds of token are "deck", "tags" and "frozen" for directive lines,
+    "note" and "inline" for notes, "delete" for delete markers and "id" for
+    lines starting with an ID.
+    Cheap string checks find where syntax could start on each line, and
+    only there are the app's regexps tried. Tokens come out the same as if
+    each kind's regexp had been run over the whole string, so tokens of
+    different kinds may overlap (e.g. an ID line inside a note).
+    """
+    syntax = CONFIG_DATA["SYNTAX"]
+    note_prefix = syntax["Begin Note"]
+    inline_prefix = syntax["Begin Inline Note"]
+    directives = [
+        ("deck", syntax["Target Deck Line"], App.DECK_REGEXP),
+        ("tags", syntax["File Tags Line"], App.TAG_REGEXP),
+    ]
+    # These can start anywhere in a line, and carry on past it.
+    unanchored = [
+        (
+            "frozen", syntax["Frozen Fields Line"] + " - ",
+            App.FROZEN_REGEXP
+        ),
+        ("delete", syntax["Delete Note Line"], RegexFile.EMPTY_REGEXP),
+    ]
+    resume = dict.fromkeys(["note", "frozen", "delete"], 0)
+    start = 0
+    while start < len(string):
+        end = string.find("\n", start)
+        if end == -1:
+            end = len(string)
+        line = string[start:end]
+        if line.startswith(ID_PREFIX) or line.startswith("<!--" + ID_PREFIX):
+            match = Note.ID_REGEXP.match(string, start)
+            if match:
+                yield make_token("id", match)
+        for kind, prefix, regexp in directives:
+            if line.startswith(prefix):
+                match = regexp.match(string, start)
+                if match:
+                    yield make_token(kind, match)
+        if line == note_prefix and start >= resume["note"]:
+            match = App.NOTE_REGEXP.match(string, start)
+            if match:
+                yield make_token("note", match)
+                resume["note"] = match.end()
+        if inline_prefix in line:
+            for match in App.INLINE_REGEXP.finditer(string, start, end):
+                yield make_token("inline", match)
+        for kind, prefix, regexp in unanchored:
+            for index in occurrences(line, prefix):
+                if start + index < resume[kind]:
+                    continue
+                match = regexp.match(string, start + index)
+                if match:
+                    yield make_token(kind, match)
+                    resume[kind] = match.end()
+        start = end + 1
+
+
+def setup_logging():
+    """Log debugging info to the log file."""
+    logging.basicConfig(
+        filename='obsidian_to_anki_log.log',
+        level=logging.DEBUG,
+        format='%(asctime)s:::%(levelname)s:::%(funcName)s:::%(message)s'
     )
 
 
-def findignore(pattern, string, ignore_spans):
-    """Yield all matches for pattern in string not in ignore_spans."""
+def init_scan_worker(config_data, note_template, fields_dict, media_ledger,
+                     custom_regexps, format_cache):
+    """Set up the global state a worker process needs to scan files.
+
+    Each worker has its own Markdown parser and cloze counter already,
+    since those are per-process.
+    """
+    setup_logging()
+    CONFIG_DATA.update(config_data)
+    NOTE_DICT_TEMPLATE.update(note_template)
+    RegexFile.EMPTY_REGEXP = CONFIG_DATA["EMPTY_REGEXP"]
+    App.FIELDS_DICT = fields_dict
+    App.MEDIA_LEDGER = media_ledger
+    App.CUSTOM_REGEXPS = custom_regexps
+    FormatConverter.CACHE = format_cache
+    App.gen_regexp()
+
+
+def scan_file_job(job):
+    """Scan a file in a worker process.
+
+    Returns the file's scan results along with the media it found, the
+    changes it made to the media ledger and the formatted fields it
+    added to the cache.
+    """
+    file = job
+    MEDIA.clear()
+    LEDGER_UPDATES.clear()
+    file.scan_file()
+    formatted = dict()
+    if FormatConverter.CACHE is not None:
+        formatted = FormatConverter.CACHE.take_added()
     return (
-        match
-        for match in pattern.finditer(string)
-        if not contained_in(match.span(), ignore_spans)
+        file.scan_results(), dict(MEDIA), dict(LEDGER_UPDATES), formatted
     )
 
 
@@ -189,6 +364,7 @@ def load_anki():
     if CONFIG_DATA["Path"] and CONFIG_DATA["Profile"]:
         print("Anki Path and Anki Profile provided.")
         print("Attempting to open Anki in selected profile...")
+        import subprocess
         subprocess.Popen(
             [CONFIG_DATA["Path"], "-p", CONFIG_DATA["Profile"]]
         )
@@ -217,22 +393,130 @@ def main():
     App()
 
 
+class HTTPTransport:
+    """Sends AnkiConnect requests, reusing one connection where possible."""
+
+    STALE_ERRORS = (
+        http.client.RemoteDisconnected,
+        http.client.BadStatusLine,
+        ConnectionResetError,
+        ConnectionAbortedError,
+        BrokenPipeError
+    )
+
+    def __init__(self, host='localhost', port=ANKI_PORT,
+                 timeout=None, keep_alive=True):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self.connection = None
+
+    def connect(self):
+        """Open a fresh connection to AnkiConnect."""
+        self.close()
+        self.connection = http.client.HTTPConnection(
+            self.host, self.port, timeout=self.timeout
+        )
+        return self.connection
+
+    def close(self):
+        """Close the current connection, if there is one."""
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def post(self, body):
+        """POST body over the current connection, returning the response."""
+        self.connection.request(
+            "POST", "/", body, {"Content-Type": "application/json"}
+        )
+        response = self.connection.getresponse()
+        data = response.read()
+        if response.status != 200:
+            raise Exception(
+                "AnkiConnect responded with HTTP status {} {}".format(
+                    response.status, response.reason
+                )
+            )
+        if response.will_close or not self.keep_alive:
+            self.close()
+        return data
+
+    def send(self, body):
+        """Send the encoded request body and return the raw response body."""
+        reused = self.connection is not None
+        if not reused:
+            self.connect()
+        try:
+            return self.post(body)
+        except HTTPTransport.STALE_ERRORS:
+            self.close()
+            if not reused:
+                raise
+            # The server dropped the idle connection before reading our
+            # request (AnkiConnect closes after every response without
+            # saying so), so it is safe to resend on a new connection.
+            logging.info(
+                "Kept-alive connection was closed by AnkiConnect, "
+                "falling back to one connection per request."
+            )
+            self.keep_alive = False
+            self.connect()
+            return self.post(body)
+        except Exception:
+            self.close()
+            raise
+
+
 class AnkiConnect:
     """Namespace for AnkiConnect functions."""
 
+    TRANSPORT = None
+
     def request(action, **params):
         """Format action and parameters into Ankiconnect style."""
-        return {'action': action, 'params': params, 'version': 6}
+        return {
+            'action': action,
+            'params': params,
+            'version': ANKI_CONNECT_VERSION
+        }
+
+    def get_transport():
+        """Get the transport used to talk to AnkiConnect, creating it once.
+
+        Anything with a send(body) -> bytes method can be assigned to
+        AnkiConnect.TRANSPORT instead, e.g. a fake server in tests.
+        """
+        if AnkiConnect.TRANSPORT is None:
+            AnkiConnect.TRANSPORT = HTTPTransport(
+                timeout=CONFIG_DATA.get("Timeout"),
+                keep_alive=CONFIG_DATA.get("Keep Alive", True)
+            )
+        return AnkiConnect.TRANSPORT
 
     def invoke(action, **params):
         """Do the action with the specified parameters."""
         requestJson = json.dumps(
             AnkiConnect.request(action, **params)
         ).encode('utf-8')
-        response = json.load(urllib.request.urlopen(
-            urllib.request.Request('http://localhost:8765', requestJson)))
+        return AnkiConnect.send(requestJson)
+
+    def send(requestJson):
+        """Send an already-encoded request and parse the response."""
+        response = json.loads(AnkiConnect.get_transport().send(requestJson))
         return AnkiConnect.parse(response)
 
+    def invoke_batched(actions):
+        """Do actions like a single multi request, but in bounded chunks.
+
+        Returns the list of responses to actions, in order.
+        """
+        return RequestBatcher(
+            max_bytes=CONFIG_DATA["Batch Max Bytes"],
+            max_actions=CONFIG_DATA["Batch Max Actions"]
+        ).invoke(actions)
+
     def parse(response):
         """Parse the received response."""
         if len(response) != 2:
@@ -246,6 +530,286 @@ class AnkiConnect:
         return response['result']
 
 
+class RequestBatcher:
+    """Splits a tree of multi requests into chunks of bounded size.
+
+    Chunks are sent one after another, so actions still run in order.
+    A multi action that is too big to fit into a chunk by itself is split
+    up recursively, and its response is put back together afterwards.
+    """
+
+    MULTI_START = b'{"action": "multi", "params": {"actions": ['
+    MULTI_END = b']}, "version": %d}' % ANKI_CONNECT_VERSION
+    SEP = b', '
+    ENVELOPE = len(MULTI_START) + len(MULTI_END)
+
+    def __init__(self, max_bytes, max_actions):
+        self.max_bytes = max_bytes
+        self.max_actions = max_actions
+
+    @staticmethod
+    def count_actions(action):
+        """Count the non-multi actions within action."""
+        if action["action"] != "multi":
+            return 1
+        return sum(
+            RequestBatcher.count_actions(sub_action)
+            for sub_action in action["params"]["actions"]
+        )
+
+    def encode(self, action):
+        """Encode action, or return None if it is a multi that needs splitting.
+
+        Stops as soon as the limit is reached, so no more than about
+        max_bytes is held at a time for an oversized multi.
+        """
+        if action["action"] != "multi":
+            return json.dumps(action).encode('utf-8')
+        if RequestBatcher.count_actions(action) > self.max_actions:
+            return None
+        parts = list()
+        size = RequestBatcher.ENVELOPE
+        for sub_action in action["params"]["actions"]:
+            encoded = self.encode(sub_action)
+            if encoded is None:
+                return None
+            size += len(encoded) + len(RequestBatcher.SEP)
+            if size > self.max_bytes:
+                return None
+            parts.append(encoded)
+        return b"".join([
+            RequestBatcher.MULTI_START,
+            RequestBatcher.SEP.join(parts),
+            RequestBatcher.MULTI_END
+        ])
+
+    def send(self, chunk):
+        """Send a chunk of encoded actions as one multi request."""
+        if not chunk:
+            return list()
+        logging.info("Sending a batch of " + str(len(chunk)) + " actions")
+        return AnkiConnect.send(
+            b"".join([
+                RequestBatcher.MULTI_START,
+                RequestBatcher.SEP.join(chunk),
+                RequestBatcher.MULTI_END
+            ])
+        )
+
+    def invoke(self, actions):
+        """Do actions in chunks, returning their responses in order."""
+        responses = list()
+        chunk, chunk_bytes, chunk_actions = list(), RequestBatcher.ENVELOPE, 0
+        for action in actions:
+            encoded = self.encode(action)
+            if encoded is None or action["action"] == "multi" and (
+                RequestBatcher.ENVELOPE + len(encoded) > self.max_bytes
+            ):
+                # Too big on its own, so split it up into its own chunks
+                responses += self.send(chunk)
+                chunk = list()
+                chunk_bytes, chunk_actions = RequestBatcher.ENVELOPE, 0
+                responses.append({
+                    "result": self.invoke(action["params"]["actions"]),
+                    "error": None
+                })
+                continue
+            count = RequestBatcher.count_actions(action)
+            if chunk and (
+                chunk_bytes + len(encoded) > self.max_bytes
+                or chunk_actions + count > self.max_actions
+            ):
+                responses += self.send(chunk)
+                chunk = list()
+                chunk_bytes, chunk_actions = RequestBatcher.ENVELOPE, 0
+            chunk.append(encoded)
+            chunk_bytes += len(encoded) + len(RequestBatcher.SEP)
+            chunk_actions += count
+        responses += self.send(chunk)
+        return responses
+
+
+class PythonMarkdownBackend:
+    """Renders Markdown with Python-Markdown. The default backend."""
+
+    def __init__(self):
+        import markdown
+        self.parser = markdown.Markdown(
+            extensions=[
+                'fenced_code',
+                'footnotes',
+                'md_in_html',
+                'tables',
+                'nl2br',
+                'sane_lists'
+            ]
+        )
+
+    def convert(self, text):
+        return self.parser.reset().convert(text)
+
+    @staticmethod
+    def version():
+        """Get the version of the library that renders the Markdown."""
+        import markdown
+        return "markdown " + markdown.__version__
+
+
+class MarkdownItBackend:
+    """Renders Markdown with markdown-it-py, a faster CommonMark engine.
+
+    Set up to match the Python-Markdown extensions where it can.
+    Footnotes need mdit-py-plugins, and are left as text without it.
+    """
+
+    def __init__(self):
+        import markdown_it
+        self.parser = markdown_it.MarkdownIt(
+            "commonmark",
+            {
+                "breaks": True,
+                "html": True,
+                "xhtmlOut": True,
+                "langPrefix": ""  # Python-Markdown uses the bare language
+            }
+        ).enable("table")
+        self.parser.add_render_rule("image", MarkdownItBackend.render_image)
+        try:
+            from mdit_py_plugins.footnote import footnote_plugin
+            self.parser.use(footnote_plugin)
+        except ImportError:
+            pass
+
+    @staticmethod
+    def version():
+        """Get the versions of the libraries that render the Markdown."""
+        import markdown_it
+        try:
+            import mdit_py_plugins
+        except ImportError:
+            return "markdown-it " + markdown_it.__version__
+        return "markdown-it {} mdit-py-plugins {}".format(
+            markdown_it.__version__, mdit_py_plugins.__version__
+        )
+
+    @staticmethod
+    def render_image(renderer, tokens, idx, options, env):
+        """Render an image with alt before src, like Python-Markdown.
+
+        FormatConverter.IMAGE_REGEXP relies on that order to find media.
+        """
+        token = tokens[idx]
+        attrs = dict(token.attrs)
+        attrs.pop("alt", None)
+        token.attrs = {
+            "alt": renderer.renderInlineAsText(
+                token.children or [], options, env
+            )
+        }
+        token.attrs.update(attrs)
+        return renderer.renderToken(tokens, idx, options, env)
+
+    def convert(self, text):
+        return self.parser.render(text)
+
+
+MARKDOWN_BACKENDS = {
+    "markdown": PythonMarkdownBackend,
+    "markdown-it": MarkdownItBackend,
+}
+
+
+def load_markdown_backend(name):
+    """Make the Markdown backend called name.
+
+    Falls back to Python-Markdown if it's unknown or not installed.
+    """
+    try:
+        return MARKDOWN_BACKENDS[name]()
+    except (KeyError, ImportError) as e:
+        print(
+            "Warning! Couldn't load Markdown backend", name,
+            "(" + repr(e) + "), using markdown instead."
+        )
+        return PythonMarkdownBackend()
+
+
+class FormatCache:
+    """Disk-backed cache of formatted fields.
+
+    Maps a field's text, whether it's a cloze, and a fingerprint of the
+    formatter to the rendered HTML and the media it refers to.
+    Entries are kept in least recently used order, and the oldest are
+    evicted on saving once the cache is over max_bytes.
+    """
+
+    def __init__(self, path, max_bytes, backend="markdown"):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.entries = dict()
+        self.added = dict()
+        try:
+            version = MARKDOWN_BACKENDS[backend].version()
+        except (KeyError, ImportError):
+            # load_markdown_backend falls back to it too
+            version = PythonMarkdownBackend.version()
+        with open(os.path.realpath(__file__), "rb") as f:
+            # So any change to the script, backend or the library it
+            # uses invalidates what it formatted
+            self.fingerprint = hashlib.sha256(
+                f.read() + version.encode('utf-8')
+            ).hexdigest()
+
+    def load(self):
+        """Load the cache from disk, starting empty if it's unreadable."""
+        try:
+            with open(self.path, encoding='utf_8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = dict()
+
+    def save(self):
+        """Evict the least recently used entries, then write to disk."""
+        size = 0
+        kept = list()
+        for key, entry in reversed(list(self.entries.items())):
+            size += len(key) + len(entry[0]) + sum(map(len, entry[1]))
+            if size > self.max_bytes:
+                break
+            kept.append((key, entry))
+        self.entries = dict(reversed(kept))
+        with open(self.path + ".tmp", "w", encoding='utf_8') as f:
+            json.dump(self.entries, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def key(self, text, cloze):
+        """Get the cache key for formatting text."""
+        return hashlib.sha256(
+            "\0".join([self.fingerprint, str(cloze), text]).encode('utf-8')
+        ).hexdigest()
+
+    def get(self, key):
+        """Get the [html, media] entry for key, or None."""
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.entries[key] = entry  # Now the most recently used
+        return entry
+
+    def put(self, key, entry):
+        """Store the [html, media] entry for key."""
+        self.entries[key] = entry
+        self.added[key] = entry
+
+    def take_added(self):
+        """Get the entries put since last called, e.g. in a worker."""
+        added, self.added = self.added, dict()
+        return added
+
+    def update(self, entries):
+        """Store entries put elsewhere, e.g. in a worker."""
+        self.entries.update(entries)
+
+
 class FormatConverter:
     """Converting Obsidian formatting to Anki formatting."""
 
@@ -269,9 +833,7 @@ class FormatConverter:
 
     ANKI_MATH_REGEXP = re.compile(r"(\\\[[\s\S]*?\\\])|(\\\([\s\S]*?\\\))")
 
-    MATH_REPLACE = "OBSTOANKIMATH"
-    INLINE_CODE_REPLACE = "OBSTOANKICODEINLINE"
-    DISPLAY_CODE_REPLACE = "OBSTOANKICODEDISPLAY"
+    MASK_PREFIX = "OBSTOANKI"
 
     IMAGE_REGEXP = re.compile(r'<img alt=".*?" src="(.*?)"')
     SOUND_REGEXP = re.compile(r'\[sound:(.+)\]')
@@ -285,6 +847,9 @@ class FormatConverter:
 
     CLOZE_UNSET_NUM = 1
 
+    CACHE = None
+    BACKEND = None  # Loaded on first use, from the config
+
     @staticmethod
     def format_note_with_url(note, url):
         for key in note["fields"]:
@@ -359,7 +924,11 @@ class FormatConverter:
     @staticmethod
     def markdown_parse(text):
         """Apply markdown conversions to text."""
-        text = md_parser.reset().convert(text)
+        if FormatConverter.BACKEND is None:
+            FormatConverter.BACKEND = load_markdown_backend(
+                CONFIG_DATA.get("Markdown Backend", "markdown")
+            )
+        text = FormatConverter.BACKEND.convert(text)
         return text
 
     @staticmethod
@@ -371,26 +940,103 @@ class FormatConverter:
 
     @staticmethod
     def get_images(html_text):
-        """Get all the images that need to be added."""
+        """Get the paths of all the local images in html_text."""
+        paths = list()
         for match in FormatConverter.IMAGE_REGEXP.finditer(html_text):
             path = match.group(1)
             if FormatConverter.is_url(path):
                 continue  # Skips over images web-hosted.
-            path = urllib.parse.unquote(path)
-            filename = os.path.basename(path)
-            if filename not in App.ADDED_MEDIA and filename not in MEDIA:
-                MEDIA[filename] = file_encode(path)
-                # Adds the filename and data to media_names
+            paths.append(urllib.parse.unquote(path))
+        return paths
 
     @staticmethod
     def get_audio(html_text):
-        """Get all the audio that needs to be added."""
-        for match in FormatConverter.SOUND_REGEXP.finditer(html_text):
-            path = match.group(1)
-            filename = os.path.basename(path)
-            if filename not in App.ADDED_MEDIA and filename not in MEDIA:
-                MEDIA[filename] = file_encode(path)
-                # Adds the filename and data to media_names
+        """Get the paths of all the local audio in html_text."""
+        return [
+            match.group(1)
+            for match in FormatConverter.SOUND_REGEXP.finditer(html_text)
+            if not FormatConverter.is_url(match.group(1))
+        ]
+
+    @staticmethod
+    def add_media(paths, base_dir=""):
+        """Add the media at paths that Anki doesn't have yet.
+
+        Relative paths are resolved against base_dir.
+        Returns the filename of each in Anki, in order.
+        """
+        return [
+            FormatConverter.media_filename(
+                os.path.abspath(os.path.join(base_dir, path))
+            )
+            for path in paths
+        ]
+
+    @staticmethod
+    def media_filename(path):
+        """Get the filename in Anki for the media at path.
+
+        App.MEDIA_LEDGER records the hash of what was sent under each
+        filename, and the path and stat it was read from. The file is only
+        hashed if its stat has changed, and only added to MEDIA (to be sent,
+        see App.get_add_media) if its contents have. A different file with
+        the same basename gets the first 8 characters of its hash added to
+        its filename.
+        """
+        filename = os.path.basename(path)
+        try:
+            stat = Directory.stat_key(os.stat(path))
+        except OSError as e:
+            print("Warning! Couldn't read media ", path, ": ", e)
+            # Anki may still have it from an earlier sync
+            return next(
+                (
+                    name for name, entry in App.MEDIA_LEDGER.items()
+                    if entry["path"] == path
+                ),
+                filename
+            )
+        taken = MEDIA.get(filename) or App.MEDIA_LEDGER.get(filename)
+        if taken is not None and taken["path"] == path and (
+            taken["stat"] == stat
+        ):
+            return filename
+        contents_hash = file_hash(path)
+        if taken is not None and taken["hash"] is None:
+            # Sent before the ledger kept hashes, so assume it's this file
+            App.MEDIA_LEDGER[filename] = {
+                "hash": contents_hash, "path": path, "stat": stat
+            }
+            LEDGER_UPDATES[filename] = App.MEDIA_LEDGER[filename]
+            return filename
+        if taken is not None and taken["path"] != path and (
+            taken["hash"] != contents_hash
+        ):
+            stem, ext = os.path.splitext(filename)
+            filename = stem + "-" + contents_hash[:8] + ext
+            taken = MEDIA.get(filename) or App.MEDIA_LEDGER.get(filename)
+        if taken is not None and taken["hash"] == contents_hash:
+            if taken["path"] == path:
+                taken["stat"] = stat
+                if filename not in MEDIA:
+                    LEDGER_UPDATES[filename] = taken
+            return filename
+        MEDIA[filename] = {"hash": contents_hash, "path": path, "stat": stat}
+        return filename
+
+    @staticmethod
+    def rename_media(html_text, filenames):
+        """Point the local images then audio in html_text at filenames."""
+        filenames = iter(filenames)
+
+        def repl(matchobject):
+            found_string = matchobject.group(0)
+            found_path = matchobject.group(1)
+            if FormatConverter.is_url(found_path):
+                return found_string
+            return found_string.replace(found_path, next(filenames))
+        html_text = FormatConverter.IMAGE_REGEXP.sub(repl, html_text)
+        return FormatConverter.SOUND_REGEXP.sub(repl, html_text)
 
     @staticmethod
     def path_to_filename(matchobject):
@@ -420,64 +1066,104 @@ class FormatConverter:
         )
 
     @staticmethod
-    def format(note_text, cloze=False):
-        """Apply all format conversions to note_text."""
+    def format(note_text, cloze=False, base_dir=""):
+        """Apply all format conversions to note_text.
+
+        Media paths in note_text are resolved against base_dir.
+        """
+        cache = FormatConverter.CACHE
+        if cache is None:
+            note_text, media = FormatConverter.render(note_text, cloze)
+        else:
+            key = cache.key(note_text, cloze)
+            entry = cache.get(key)
+            if entry is None:
+                entry = FormatConverter.render(note_text, cloze)
+                cache.put(key, entry)
+            note_text, media = entry
+        filenames = FormatConverter.add_media(media, base_dir)
+        if any(
+            filename != os.path.basename(path)
+            for filename, path in zip(filenames, media)
+        ):
+            note_text = FormatConverter.rename_media(note_text, filenames)
+        return note_text
+
+    @staticmethod
+    def mask_prefix(text):
+        """Get a prefix for placeholders that doesn't occur in text.
+
+        So text that happens to look like a placeholder is left alone.
+        """
+        prefix = FormatConverter.MASK_PREFIX
+        while prefix in text:
+            prefix += "X"
+        return prefix
+
+    @staticmethod
+    def mask(text, regexp, prefix, matches):
+        """Replace matches of regexp in text with numbered placeholders.
+
+        Each match is appended to matches, and its placeholder is prefix
+        followed by its index in matches and a Z.
+        """
+        def repl(match):
+            matches.append(match.group(0))
+            return prefix + str(len(matches) - 1) + "Z"
+        return regexp.sub(repl, text)
+
+    @staticmethod
+    def unmask(text, prefix, matches, escape=False):
+        """Put matches back in place of their placeholders, in one pass.
+
+        Placeholders inside a match (e.g. code in a code block) are put
+        back too. With escape, matches are HTML-escaped.
+        """
+        placeholder = re.compile(re.escape(prefix) + r"(\d+)Z")
+
+        def repl(match):
+            found = placeholder.sub(repl, matches[int(match.group(1))])
+            return html.escape(found) if escape else found
+        return placeholder.sub(repl, text)
+
+    @staticmethod
+    def render(note_text, cloze=False):
+        """Get [html, media paths] for note_text.
+
+        Doesn't depend on anything but its arguments, so can be cached.
+        """
         note_text = FormatConverter.obsidian_to_anki_math(note_text)
-        # Extract the parts that are anki math
-        math_matches = [
-            math_match.group(0)
-            for math_match in FormatConverter.ANKI_MATH_REGEXP.finditer(
-                note_text
-            )
-        ]
-        # Replace them to be later added back, so they don't interfere
-        # with markdown parsing
-        note_text = FormatConverter.ANKI_MATH_REGEXP.sub(
-            FormatConverter.MATH_REPLACE, note_text
+        prefix = FormatConverter.mask_prefix(note_text)
+        math_prefix, code_prefix = prefix + "MATH", prefix + "CODE"
+        # Replace the parts that are anki math, to be later added back,
+        # so they don't interfere with markdown parsing
+        math_matches = list()
+        note_text = FormatConverter.mask(
+            note_text, FormatConverter.ANKI_MATH_REGEXP,
+            math_prefix, math_matches
         )
         # Now same with code!
-        inline_code_matches = [
-            code_match.group(0)
-            for code_match in FormatConverter.OBS_CODE_REGEXP.finditer(
-                note_text
-            )
-        ]
-        note_text = FormatConverter.OBS_CODE_REGEXP.sub(
-            FormatConverter.INLINE_CODE_REPLACE, note_text
+        code_matches = list()
+        note_text = FormatConverter.mask(
+            note_text, FormatConverter.OBS_CODE_REGEXP,
+            code_prefix, code_matches
         )
-        display_code_matches = [
-            code_match.group(0)
-            for code_match in FormatConverter.OBS_DISPLAY_CODE_REGEXP.finditer(
-                note_text
-            )
-        ]
-        note_text = FormatConverter.OBS_DISPLAY_CODE_REGEXP.sub(
-            FormatConverter.DISPLAY_CODE_REPLACE, note_text
+        note_text = FormatConverter.mask(
+            note_text, FormatConverter.OBS_DISPLAY_CODE_REGEXP,
+            code_prefix, code_matches
         )
         if cloze:
             note_text = FormatConverter.curly_to_cloze(note_text)
-        for code_match in inline_code_matches:
-            note_text = note_text.replace(
-                FormatConverter.INLINE_CODE_REPLACE,
-                code_match,
-                1
-            )
-        for code_match in display_code_matches:
-            note_text = note_text.replace(
-                FormatConverter.DISPLAY_CODE_REPLACE,
-                code_match,
-                1
-            )
+        note_text = FormatConverter.unmask(
+            note_text, code_prefix, code_matches
+        )
         note_text = FormatConverter.markdown_parse(note_text)
         # Add back the parts that are anki math
-        for math_match in math_matches:
-            note_text = note_text.replace(
-                FormatConverter.MATH_REPLACE,
-                html.escape(math_match),
-                1
-            )
-        FormatConverter.get_images(note_text)
-        FormatConverter.get_audio(note_text)
+        note_text = FormatConverter.unmask(
+            note_text, math_prefix, math_matches, escape=True
+        )
+        media = FormatConverter.get_images(note_text)
+        media += FormatConverter.get_audio(note_text)
         note_text = FormatConverter.fix_image_src(note_text)
         note_text = FormatConverter.fix_audio_src(note_text)
         note_text = note_text.strip()
@@ -489,7 +1175,7 @@ class FormatConverter:
         ):
             note_text = note_text[len(FormatConverter.PARA_OPEN):]
             note_text = note_text[:-len(FormatConverter.PARA_CLOSE)]
-        return note_text
+        return [note_text, media]
 
 
 class Note:
@@ -503,9 +1189,10 @@ class Note:
         r"(?:<!--)?" + ID_PREFIX + r"(\d+)"
     )
 
-    def __init__(self, note_text):
+    def __init__(self, note_text, base_dir=""):
         """Set up useful variables."""
         self.text = note_text
+        self.base_dir = base_dir
         self.lines = self.text.splitlines()
         self.current_field_num = 0
         if Note.ID_REGEXP.match(self.lines[-1]):
@@ -547,7 +1234,8 @@ class Note:
                 cloze=(
                     "Cloze" in self.note_type
                     and CONFIG_DATA["CurlyCloze"]
-                )
+                ),
+                base_dir=self.base_dir
             )
             for key, value in fields.items()
         }
@@ -579,8 +1267,9 @@ class InlineNote(Note):
     TAG_REGEXP = re.compile(TAG_PREFIX + r"(.*)")
     TYPE_REGEXP = re.compile(r"\[(.*?)\]")  # So e.g. [Basic]
 
-    def __init__(self, note_text):
+    def __init__(self, note_text, base_dir=""):
         self.text = note_text.strip()
+        self.base_dir = base_dir
         self.current_field_num = 0
         ID = InlineNote.ID_REGEXP.search(self.text)
         if ID is not None:
@@ -616,7 +1305,8 @@ class InlineNote(Note):
                 cloze=(
                     "Cloze" in self.note_type
                     and CONFIG_DATA["CurlyCloze"]
-                )
+                ),
+                base_dir=self.base_dir
             )
             for key, value in fields.items()
         }
@@ -627,21 +1317,41 @@ class RegexNote:
     ID_REGEXP_STR = r"\n?(?:<!--)?(?:" + ID_PREFIX + r"(\d+).*)"
     TAG_REGEXP_STR = r"(" + TAG_PREFIX + r".*)"
 
-    def __init__(self, matchobject, note_type, tags=False, id=False):
+    @staticmethod
+    def compile(regexp):
+        """Compile regexp, then its variants with tags and an ID.
+
+        Returns regexp and a list of variants to try, in turn, wherever
+        it matches: tags and ID, ID, then tags. Optional tags and ID
+        groups wouldn't do, since a greedy regexp would swallow those
+        lines. regexp and each variant have empty groups in place of any
+        tags or ID, so all have the same groups.
+        """
+        variants = [
+            re.compile(
+                regexp + tags + identifier, flags=re.MULTILINE
+            )
+            for tags, identifier in [
+                (RegexNote.TAG_REGEXP_STR, RegexNote.ID_REGEXP_STR),
+                (r"()", RegexNote.ID_REGEXP_STR),
+                (RegexNote.TAG_REGEXP_STR, r"()"),
+                (r"()", r"()"),
+            ]
+        ]
+        return variants.pop(), variants
+
+    def __init__(self, matchobject, note_type, base_dir=""):
         self.match = matchobject
+        self.base_dir = base_dir
         self.note_type = note_type
         self.groups = list(self.match.groups())
+        # The last two groups are always the tags and ID, maybe empty
+        identifier = self.groups.pop()
+        tags = self.groups.pop()
         self.group_num = len(self.groups)
-        if id:
-            # This means id is last group
-            self.identifier = int(self.groups.pop())
-        else:
-            self.identifier = None
+        self.identifier = int(identifier) if identifier else None
         if tags:
-            # Even if id were present, tags is now last group
-            self.tags = self.groups.pop()[len(TAG_PREFIX):].split(
-                TAG_SEP
-            )
+            self.tags = tags[len(TAG_PREFIX):].split(TAG_SEP)
         else:
             self.tags = list()
         self.field_names = App.FIELDS_DICT[self.note_type]
@@ -658,7 +1368,8 @@ class RegexNote:
                 cloze=(
                     "Cloze" in self.note_type
                     and CONFIG_DATA["CurlyCloze"]
-                )
+                ),
+                base_dir=self.base_dir
             )
             for key, value in fields.items()
         }
@@ -753,16 +1464,57 @@ class Config:
         config["Defaults"].setdefault(
             "Anki Profile", ""
         )
+        config["Defaults"].setdefault(
+            "AnkiConnect Timeout", ""
+        )
+        config["Defaults"].setdefault(
+            "AnkiConnect Keep Alive", "True"
+        )
+        config["Defaults"].setdefault(
+            "Bulk Add", "False"
+        )
+        config["Defaults"].setdefault(
+            "Bulk Add Chunk Size", "500"
+        )
+        config["Defaults"].setdefault(
+            "Batch Max Bytes", "8000000"
+        )
+        config["Defaults"].setdefault(
+            "Batch Max Actions", "2000"
+        )
+        config["Defaults"].setdefault(
+            "Exclude Patterns", ""
+        )
+        config["Defaults"].setdefault(
+            "Markdown Backend", "markdown"
+        )
+        config["Defaults"].setdefault(
+            "Media Upload", "auto"
+        )
+        config["Defaults"].setdefault(
+            "Media Batch Max Bytes", "16000000"
+        )
+        config["Defaults"].setdefault(
+            "Format Cache", "True"
+        )
+        config["Defaults"].setdefault(
+            "Format Cache Max Bytes", "16000000"
+        )
 
-    def update_config():
-        """Update config with new notes."""
+    def update_config(note_types=None):
+        """Update config with new notes.
+
+        note_types can be passed in if they're already known, to save
+        asking Anki for them again.
+        """
         print("Updating configuration file...")
         config = configparser.ConfigParser()
         config.optionxform = str
         if os.path.exists(CONFIG_PATH):
             print("Config file exists, reading...")
             config.read(CONFIG_PATH, encoding='utf-8-sig')
-        note_types = AnkiConnect.invoke("modelNames")
+        if note_types is None:
+            note_types = AnkiConnect.invoke("modelNames")
         config.setdefault("Custom Regexps", dict())
         for note in note_types:
             config["Custom Regexps"].setdefault(note, "")
@@ -806,6 +1558,7 @@ class Config:
         CONFIG_DATA["FROZEN_LINE"] = re.escape(
             config["Syntax"]["Frozen Fields Line"]
         )
+        CONFIG_DATA["SYNTAX"] = dict(config["Syntax"])  # For tokenize
 
     @staticmethod
     def load_defaults(config):
@@ -826,6 +1579,56 @@ class Config:
         )
         CONFIG_DATA["Path"] = config["Defaults"]["Anki Path"]
         CONFIG_DATA["Profile"] = config["Defaults"]["Anki Profile"]
+        timeout = config["Defaults"].get("AnkiConnect Timeout", "")
+        CONFIG_DATA["Timeout"] = float(timeout) if timeout else None
+        CONFIG_DATA["Keep Alive"] = config.getboolean(
+            "Defaults", "AnkiConnect Keep Alive", fallback=True
+        )
+        CONFIG_DATA["Bulk Add"] = config.getboolean(
+            "Defaults", "Bulk Add", fallback=False
+        )
+        CONFIG_DATA["Bulk Add Chunk Size"] = max(1, config.getint(
+            "Defaults", "Bulk Add Chunk Size", fallback=500
+        ))
+        CONFIG_DATA["Batch Max Bytes"] = max(1, config.getint(
+            "Defaults", "Batch Max Bytes", fallback=8000000
+        ))
+        CONFIG_DATA["Batch Max Actions"] = max(1, config.getint(
+            "Defaults", "Batch Max Actions", fallback=2000
+        ))
+        CONFIG_DATA["Exclude Patterns"] = [
+            pattern.strip()
+            for pattern in re.split(
+                r"[,\n]",
+                config["Defaults"].get("Exclude Patterns", "")
+            )
+            if pattern.strip() and not pattern.strip().startswith("#")
+        ]
+        CONFIG_DATA["Markdown Backend"] = config["Defaults"].get(
+            "Markdown Backend", "markdown"
+        ).strip() or "markdown"
+        FormatConverter.BACKEND = None  # So a new backend takes effect
+        CONFIG_DATA["Media Upload"] = config["Defaults"].get(
+            "Media Upload", "auto"
+        ).strip().lower()
+        if CONFIG_DATA["Media Upload"] not in ("auto", "path", "base64"):
+            print(
+                "Warning! Media Upload should be auto, path or base64,",
+                "not", CONFIG_DATA["Media Upload"], "- using auto."
+            )
+            CONFIG_DATA["Media Upload"] = "auto"
+        CONFIG_DATA["Media Batch Max Bytes"] = max(1, config.getint(
+            "Defaults", "Media Batch Max Bytes", fallback=16000000
+        ))
+        CONFIG_DATA["Format Cache"] = config.getboolean(
+            "Defaults", "Format Cache", fallback=True
+        )
+        CONFIG_DATA["Format Cache Max Bytes"] = max(0, config.getint(
+            "Defaults", "Format Cache Max Bytes", fallback=16000000
+        ))
+        if isinstance(AnkiConnect.TRANSPORT, HTTPTransport):
+            AnkiConnect.TRANSPORT.close()
+            AnkiConnect.TRANSPORT = None  # So new settings take effect
         CONFIG_DATA["Vault"] = config["Obsidian"]["Vault name"]
         CONFIG_DATA["Add file link"] = config.getboolean(
             "Obsidian", "Add file link"
@@ -839,7 +1642,7 @@ class Config:
         config.read(CONFIG_PATH, encoding='utf-8-sig')
         Config.load_syntax(config)
         Config.load_defaults(config)
-        CONFIG_DATA["CUSTOM_REGEXPS"] = config["Custom Regexps"]
+        CONFIG_DATA["CUSTOM_REGEXPS"] = dict(config["Custom Regexps"])
         print("Loaded successfully!")
 
 
@@ -862,14 +1665,24 @@ class Data:
         """Loads the data file into memory"""
         with open(DATA_PATH, "r") as f:
             data = json.load(f)
-        App.ADDED_MEDIA = data.get("Added Media", list())
+        App.MEDIA_LEDGER = data.get("Media Ledger", {
+            # Media added before there was a ledger
+            filename: {"hash": None, "path": None, "stat": None}
+            for filename in data.get("Added Media", list())
+        })
         App.FILE_HASHES = data.get("File Hashes", dict())
+        App.FILE_STATS = data.get("File Stats", dict())
+        # Older data files map each name to its ID and fields
+        App.NOTE_TYPES = list(data.get("Note Types", list()))
 
 
 class App:
     """Master class that manages the application."""
 
     SUPPORTED_EXTS = [".md", ".txt"]
+    ID_QUERY_SIZE = 1000
+    CUSTOM_REGEXPS = dict()
+    GOOEY = None  # The gooey module, once loaded for the GUI
 
     def __init__(self):
         """Execute the main functionality of the script."""
@@ -886,14 +1699,14 @@ class App:
             print("Error:", e)
             Data.create_data_file()
             Data.load_data_file()
-        self.get_fields()
-        self.get_ids()
-        if CONFIG_DATA["GUI"] and GOOEY:
-            self.setup_gui_parser()
+        if CONFIG_DATA["GUI"]:
+            App.load_gooey()
+        if App.GOOEY:
+            App.GOOEY.Gooey(use_cmd_args=True)(self.setup_gui_parser)()
         else:
             self.setup_cli_parser()
         args = self.parser.parse_args()
-        if CONFIG_DATA["GUI"] and GOOEY:
+        if App.GOOEY:
             if args.directory:
                 args.path = args.directory
             elif args.file:
@@ -901,9 +1714,10 @@ class App:
             else:
                 args.path = False
         no_args = True
+        App.SESSION = self.bootstrap(refresh=args.update)
         if args.update:
             no_args = False
-            Config.update_config()
+            Config.update_config(list(App.SESSION.note_types))
             Config.load_config()
         if args.mediaupdate:
             no_args = False
@@ -911,85 +1725,80 @@ class App:
         self.gen_regexp()
         if args.config:
             no_args = False
+            import webbrowser
             webbrowser.open(CONFIG_PATH)
             return
         if args.path:
             no_args = False
-            current = os.getcwd()
-            self.path = args.path
+            self.path = os.path.abspath(args.path)
+            if args.regex:
+                self.gen_custom_regexps()
+            if CONFIG_DATA["Format Cache"]:
+                FormatConverter.CACHE = FormatCache(
+                    FORMAT_CACHE_PATH,
+                    CONFIG_DATA["Format Cache Max Bytes"],
+                    CONFIG_DATA["Markdown Backend"]
+                )
+                FormatConverter.CACHE.load()
             directories = list()
             if os.path.isdir(self.path):
-                os.chdir(self.path)
-                if args.recurse:
-                    directories = list()
-                    for root, dirs, files in os.walk(os.getcwd()):
-                        directories.append(
-                            Directory(root, regex=args.regex)
-                        )
-                        for dir in dirs:
-                            if dir.startswith("."):
-                                dirs.remove(dir)
-                                # So, ignore . folders
-                else:
-                    directories = [
-                        Directory(
-                            os.getcwd(), regex=args.regex
-                        )
-                    ]
-                os.chdir(current)
+                walker = VaultWalker(
+                    self.path,
+                    patterns=CONFIG_DATA["Exclude Patterns"],
+                    recurse=args.recurse
+                )
+                directories = [
+                    Directory(
+                        directory, regex=args.regex, file_stats=file_stats
+                    )
+                    for directory, file_stats in walker.walk()
+                ]
             else:
-                # Still need to get to directory of file for image resolving
-                # So, go to directory where file is (hopefully)
-                # But, if just file name is given (e.g. cli), don't want to
-                # Break anything.
-                if os.path.dirname(self.path):
-                    file_dir = os.path.dirname(self.path)
-                else:
-                    file_dir = current
+                # Images are resolved relative to the file's directory
+                file_dir = os.path.dirname(self.path)
                 directories = [
                     Directory(
                         file_dir, regex=args.regex, onefile=self.path
                     )
                 ]
+            self.scan_directories(directories, args.jobs)
+            self.get_ids(directories)
+            for directory in directories:
+                for file in directory.files:
+                    file.remove_missing_notes()
+            if CONFIG_DATA["Bulk Add"]:
+                self.check_new_notes(directories)
+            self.find_changed_media()
             requests = list()
-            print("Getting tag list")
-            requests.append(
-                AnkiConnect.request(
-                    "getTags"
-                )
-            )
             print("Adding media with these filenames...")
             print(list(MEDIA.keys()))
-            requests.append(self.get_add_media())
+            self.add_media()
             print("Adding directory requests...")
             for directory in directories:
                 requests.append(directory.requests_1())
-            result = AnkiConnect.invoke(
-                "multi",
-                actions=requests
-            )
-            tags = AnkiConnect.parse(result[0])
-            directory_responses = result[2:]
+            directory_responses = AnkiConnect.invoke_batched(requests)
             for directory, response in zip(directories, directory_responses):
-                directory.parse_requests_1(AnkiConnect.parse(response), tags)
+                directory.parse_requests_1(AnkiConnect.parse(response))
             requests = list()
+            print("Moving cards to target decks...")
+            requests.append(self.get_change_decks(directories))
             for directory in directories:
                 requests.append(directory.requests_2())
-            AnkiConnect.invoke(
-                "multi",
-                actions=requests
-            )
-            App.ADDED_MEDIA = set(App.ADDED_MEDIA)
-            App.ADDED_MEDIA.update(MEDIA.keys())
-            App.ADDED_MEDIA = list(App.ADDED_MEDIA)
+            AnkiConnect.invoke_batched(requests)
+            App.MEDIA_LEDGER.update(MEDIA)
             for directory in directories:
                 App.FILE_HASHES.update(directory.hashes())
+                App.FILE_STATS.update(directory.file_stats())
             Data.update_data_file(
                 {
-                    "Added Media": App.ADDED_MEDIA,
-                    "File Hashes": App.FILE_HASHES
+                    "Media Ledger": App.MEDIA_LEDGER,
+                    "File Hashes": App.FILE_HASHES,
+                    "File Stats": App.FILE_STATS,
+                    "Note Types": App.NOTE_TYPES
                 }
             )
+            if FormatConverter.CACHE is not None:
+                FormatConverter.CACHE.save()
         if no_args:
             self.parser.print_help()
 
@@ -1026,35 +1835,53 @@ class App:
             dest="recurse",
             help="Recursively scan subfolders."
         )
+        self.parser.add_argument(
+            "-j", "--jobs",
+            type=int,
+            dest="jobs",
+            help="Number of processes to scan files with.",
+            default=1
+        )
 
-    if GOOEY:
-        @ gooey.Gooey(use_cmd_args=True)
-        def setup_gui_parser(self):
-            """Set up the GUI argument parser."""
-            self.parser = gooey.GooeyParser(
-                description="Add cards to Anki from a markdown or text file."
-            )
-            path_group = self.parser.add_mutually_exclusive_group(
-                required=False
-            )
-            path_group.add_argument(
-                "-f", "--file",
-                help="Choose a file to scan.",
-                dest="file",
-                widget='FileChooser'
-            )
-            path_group.add_argument(
-                "-d", "--dir",
-                help="Choose a directory to scan.",
-                dest="directory",
-                widget='DirChooser'
-            )
-            self.setup_parser_optionals()
+    @staticmethod
+    def load_gooey():
+        """Import Gooey for the GUI, if it's installed."""
+        try:
+            import gooey
+        except ModuleNotFoundError:
+            print("Gooey not installed, switching to cli...")
+        else:
+            App.GOOEY = gooey
 
-    def setup_cli_parser(self):
-        """Setup the command-line argument parser."""
-        self.parser = argparse.ArgumentParser(
-            description="Add cards to Anki from a markdown or text file."
+    def setup_gui_parser(self):
+        """Set up the GUI argument parser.
+
+        Must be called wrapped in the Gooey decorator.
+        """
+        self.parser = App.GOOEY.GooeyParser(
+            description="Add cards to Anki from a markdown or text file."
+        )
+        path_group = self.parser.add_mutually_exclusive_group(
+            required=False
+        )
+        path_group.add_argument(
+            "-f", "--file",
+            help="Choose a file to scan.",
+            dest="file",
+            widget='FileChooser'
+        )
+        path_group.add_argument(
+            "-d", "--dir",
+            help="Choose a directory to scan.",
+            dest="directory",
+            widget='DirChooser'
+        )
+        self.setup_parser_optionals()
+
+    def setup_cli_parser(self):
+        """Setup the command-line argument parser."""
+        self.parser = argparse.ArgumentParser(
+            description="Add cards to Anki from a markdown or text file."
         )
         self.parser.add_argument(
             "path",
@@ -1064,7 +1891,8 @@ class App:
         )
         self.setup_parser_optionals()
 
-    def gen_regexp(self):
+    @staticmethod
+    def gen_regexp():
         """Generate the regular expressions used by the app."""
         setattr(
             App, "NOTE_REGEXP",
@@ -1151,97 +1979,482 @@ class App:
             )
         )
 
+    @staticmethod
+    def gen_custom_regexps():
+        """Compile the custom regexps once, for every file to use.
+
+        Invalid regexps, and ones for note types Anki doesn't have, are
+        reported and skipped here rather than while scanning.
+        """
+        App.CUSTOM_REGEXPS = dict()
+        for note_type, regexp in CONFIG_DATA["CUSTOM_REGEXPS"].items():
+            if not regexp:
+                continue
+            if note_type not in App.FIELDS_DICT:
+                print(
+                    "Warning! Skipping custom regexp for unknown note type",
+                    note_type
+                )
+                continue
+            try:
+                App.CUSTOM_REGEXPS[note_type] = RegexNote.compile(regexp)
+            except re.error as e:
+                print(
+                    "Error! Skipping invalid custom regexp for note type",
+                    note_type, ":", e
+                )
+
+    def scan_directories(self, directories, jobs):
+        """Scan the changed files of every directory.
+
+        With more than one job, files are scanned in a pool of processes.
+        A file whose media has the same name as different media from an
+        earlier file is scanned again here, so its media gets the name it
+        would have had in one process.
+        """
+        scan_jobs = [
+            file
+            for directory in directories
+            for file in directory.files
+        ]
+        if jobs <= 1 or len(scan_jobs) <= 1:
+            for directory in directories:
+                directory.scan_files()
+            return
+        print("Scanning", len(scan_jobs), "files with", jobs, "processes...")
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=init_scan_worker,
+            initargs=(
+                CONFIG_DATA,
+                NOTE_DICT_TEMPLATE,
+                App.FIELDS_DICT,
+                App.MEDIA_LEDGER,
+                App.CUSTOM_REGEXPS,
+                FormatConverter.CACHE
+            )
+        ) as pool:
+            results = pool.map(
+                scan_file_job, scan_jobs,
+                chunksize=max(1, len(scan_jobs) // (jobs * 4))
+            )
+            rescan = list()
+            for file, (scanned, media, ledger, formatted) in zip(
+                scan_jobs, results
+            ):
+                if FormatConverter.CACHE is not None:
+                    FormatConverter.CACHE.update(formatted)
+                if any(
+                    filename in MEDIA
+                    and MEDIA[filename]["hash"] != entry["hash"]
+                    for filename, entry in media.items()
+                ) or any(
+                    App.MEDIA_LEDGER[filename]["hash"] is not None
+                    and App.MEDIA_LEDGER[filename]["path"] != entry["path"]
+                    for filename, entry in ledger.items()
+                ):
+                    # An earlier file has different media by that name,
+                    # so this one's media needs renaming.
+                    rescan.append(file)
+                    continue
+                vars(file).update(scanned)
+                for filename, entry in media.items():
+                    MEDIA.setdefault(filename, entry)
+                App.MEDIA_LEDGER.update(ledger)
+        for file in rescan:
+            logging.info("Rescanning " + file.filename + " for its media")
+            file.scan_file()
+
+    @staticmethod
+    def find_changed_media():
+        """Add media that's changed since it was sent to MEDIA.
+
+        Even if no note using it has changed. Only files whose stat has
+        changed are hashed, and they keep their filename in Anki.
+        """
+        for filename, entry in App.MEDIA_LEDGER.items():
+            if filename in MEDIA or entry["path"] is None:
+                continue
+            try:
+                stat = Directory.stat_key(os.stat(entry["path"]))
+            except OSError:
+                continue  # Anki keeps its copy
+            if stat == entry["stat"]:
+                continue
+            contents_hash = file_hash(entry["path"])
+            if contents_hash == entry["hash"]:
+                entry["stat"] = stat
+                continue
+            MEDIA[filename] = {
+                "hash": contents_hash, "path": entry["path"], "stat": stat
+            }
+
+    def add_media(self):
+        """Send MEDIA to Anki, a batch at a time.
+
+        Media that fails to be added is warned about and dropped from
+        MEDIA, so it isn't recorded as added.
+        """
+        for actions in self.get_add_media():
+            responses = AnkiConnect.invoke_batched(actions)
+            for action, response in zip(actions, responses):
+                try:
+                    AnkiConnect.parse(response)
+                except Exception as e:
+                    filename = action["params"]["filename"]
+                    print(
+                        "Warning! Could not add media ", filename, ": ", e
+                    )
+                    del MEDIA[filename]
+            # Let go of this batch before the next is encoded
+            del actions, responses
+
     def get_add_media(self):
-        """Get the AnkiConnect-formatted add_media request."""
-        return AnkiConnect.request(
-            "multi",
-            actions=[
+        """Yield batches of AnkiConnect-formatted storeMediaFile actions.
+
+        Media is sent by path if Anki can read it from there. Otherwise
+        files are read and encoded as base64 only as their batch is made,
+        and a batch holds at most Media Batch Max Bytes of encoded data
+        (or one file, if that's bigger). So however much media there is,
+        only about one batch of it is in memory at once.
+        """
+        if not MEDIA:
+            return
+        if App.check_media_by_path():
+            logging.info("Sending media by path")
+            yield [
                 AnkiConnect.request(
                     "storeMediaFile",
                     filename=key,
-                    data=value
+                    path=value["path"]
                 )
                 for key, value in MEDIA.items()
             ]
-        )
+            return
+        batch, size = list(), 0
+        for key, value in list(MEDIA.items()):
+            try:
+                data = file_encode(value["path"])
+            except OSError as e:
+                print("Warning! Could not add media ", key, ": ", e)
+                del MEDIA[key]
+                continue
+            if batch and size + len(data) > CONFIG_DATA[
+                "Media Batch Max Bytes"
+            ]:
+                yield batch
+                batch, size = list(), 0
+            batch.append(
+                AnkiConnect.request(
+                    "storeMediaFile",
+                    filename=key,
+                    data=data
+                )
+            )
+            size += len(data)
+        if batch:
+            yield batch
 
-    def get_fields(self):
-        """Get the user's current note types and fields."""
-        note_types = AnkiConnect.invoke("modelNames")
-        fields_request = [
-            AnkiConnect.request(
-                "modelFieldNames", modelName=note
+    @staticmethod
+    def check_media_by_path():
+        """Check whether Anki can read media from our paths.
+
+        Follows the Media Upload option, which on auto asks Anki to store
+        a temporary file by path. skipHash is set to the file's hash, so
+        nothing is stored if Anki can read it, and there's an error if it
+        can't (e.g. Anki is on another machine or in a container).
+        """
+        if CONFIG_DATA["Media Upload"] != "auto":
+            return CONFIG_DATA["Media Upload"] == "path"
+        import tempfile
+        contents = os.urandom(16)
+        with tempfile.NamedTemporaryFile(
+            suffix=".txt", delete=False
+        ) as probe:
+            probe.write(contents)
+        filename = "_obsidian_to_anki_probe.txt"
+        try:
+            result = AnkiConnect.invoke(
+                "storeMediaFile",
+                filename=filename,
+                path=probe.name,
+                skipHash=hashlib.md5(contents).hexdigest()
             )
-            for note in note_types
+        except Exception as e:
+            logging.info("Anki can't read media by path: " + str(e))
+            return False
+        finally:
+            os.remove(probe.name)
+        if result is not None:
+            # This AnkiConnect stored it anyway, so tidy up.
+            AnkiConnect.invoke("deleteMediaFile", filename=filename)
+        return True
+
+    def get_change_decks(self, directories):
+        """Get the AnkiConnect-formatted request to change decks.
+
+        Only cards that aren't already in their target deck are moved,
+        with one changeDeck action per target deck.
+        """
+        files = [file for directory in directories for file in directory.files]
+        cards = [card for file in files for card in file.cards]
+        current_decks = dict()
+        if cards:
+            try:
+                decks = AnkiConnect.invoke("getDecks", cards=cards)
+            except Exception as e:
+                # Without the current decks, just move everything.
+                logging.info("Couldn't get current decks: " + str(e))
+            else:
+                current_decks = {
+                    card: deck.lower()
+                    for deck, deck_cards in decks.items()
+                    for card in deck_cards
+                }
+        to_move = collections.defaultdict(list)
+        for file in files:
+            for card in file.cards:
+                if current_decks.get(card) != file.target_deck.lower():
+                    to_move[file.target_deck].append(card)
+        return AnkiConnect.request(
+            "multi",
+            actions=[
+                AnkiConnect.request("changeDeck", cards=deck_cards, deck=deck)
+                for deck, deck_cards in to_move.items()
+            ]
+        )
+
+    def bootstrap(self, refresh=False):
+        """Get everything needed from Anki before scanning, in one request.
+
+        The fields of the note types seen last time are fetched along
+        with it, so a second request is only made for new note types.
+        """
+        cached = list() if refresh else App.NOTE_TYPES
+        responses = AnkiConnect.invoke(
+            "multi", actions=[
+                AnkiConnect.request("version"),
+                AnkiConnect.request("modelNames")
+            ] + [
+                AnkiConnect.request("modelFieldNames", modelName=note_type)
+                for note_type in cached
+            ]
+        )
+        version, note_types = [
+            AnkiConnect.parse(response) for response in responses[:2]
         ]
-        result = AnkiConnect.invoke(
-            "multi", actions=fields_request
+        fields = {
+            note_type: response["result"]
+            for note_type, response in zip(cached, responses[2:])
+            if response["error"] is None
+            # Otherwise the note type is gone
+        }
+        if version < ANKI_CONNECT_VERSION:
+            print(
+                "Warning! AnkiConnect version ",
+                version,
+                " is older than the expected version ",
+                ANKI_CONNECT_VERSION
+            )
+        self.get_fields(note_types, fields)
+        return Session(
+            version=version,
+            note_types=note_types,
+            fields=App.FIELDS_DICT
         )
+
+    def get_fields(self, note_types, fields):
+        """Get the fields of the given note types.
+
+        fields has those already fetched, by note type. The rest are
+        fetched now, and the names of all are saved in the data file.
+        """
+        to_fetch = [
+            note_type
+            for note_type in note_types
+            if note_type not in fields
+        ]
+        fetched = dict(fields)
+        if to_fetch:
+            logging.info("Fetching fields for note types " + str(to_fetch))
+            result = AnkiConnect.invoke(
+                "multi", actions=[
+                    AnkiConnect.request(
+                        "modelFieldNames", modelName=note_type
+                    )
+                    for note_type in to_fetch
+                ]
+            )
+            fetched.update(
+                (note_type, AnkiConnect.parse(response))
+                for note_type, response in zip(to_fetch, result)
+            )
+        App.NOTE_TYPES = list(note_types)
         setattr(
             App, "FIELDS_DICT",
             {
-                note_type: AnkiConnect.parse(fields)
-                for note_type, fields in zip(
-                    note_types,
-                    result
-                )
+                note_type: fetched[note_type]
+                for note_type in note_types
             }
         )
 
-    def get_ids(self):
-        """Get a list of the currently used card IDs."""
-        setattr(App, "EXISTING_IDS", AnkiConnect.invoke("findNotes", query=""))
+    def check_new_notes(self, directories):
+        """Find the new notes Anki can't add, to leave them out of addNotes.
+
+        addNotes fails as a whole if any note can't be added, yet keeps
+        the notes it could add, so they're checked beforehand. That
+        includes notes that duplicate another new note.
+        """
+        new_notes = [
+            (file, index, note)
+            for directory in directories
+            for file in directory.files
+            for index, note in enumerate(
+                file.notes_to_add + file.inline_notes_to_add
+            )
+        ]
+        if not new_notes:
+            return
+        size = CONFIG_DATA["Bulk Add Chunk Size"]
+        responses = AnkiConnect.invoke_batched([
+            AnkiConnect.request(
+                "canAddNotesWithErrorDetail",
+                notes=[note for _, _, note in new_notes[start:start + size]]
+            )
+            for start in range(0, len(new_notes), size)
+        ])
+        try:
+            checks = [
+                check
+                for response in responses
+                for check in AnkiConnect.parse(response)
+            ]
+        except Exception as e:
+            # An older AnkiConnect, whose addNotes gives null for each
+            # note it can't add instead.
+            logging.info("Couldn't check notes before adding: " + str(e))
+            checks = [{"canAdd": True}] * len(new_notes)
+        seen = set()
+        for (file, index, note), check in zip(new_notes, checks):
+            key = (
+                note["modelName"], note["deckName"],
+                next(iter(note["fields"].values()), "").strip()
+            )
+            if not check["canAdd"]:
+                file.add_errors[index] = check["error"]
+            elif key in seen and not note["options"]["allowDuplicate"]:
+                file.add_errors[index] = (
+                    "cannot create note because it is a duplicate "
+                    "of another new note"
+                )
+            else:
+                seen.add(key)
+
+    def get_ids(self, directories):
+        """Get the set of note IDs from the scanned files that exist in Anki.
+
+        Only asks Anki about the IDs actually found, rather than listing
+        every note in the collection.
+        """
+        ids = sorted({
+            parsed.id
+            for directory in directories
+            for file in directory.files
+            for parsed in file.notes_to_edit
+        })
+        App.EXISTING_IDS = set()
+        if not ids:
+            return
+        result = AnkiConnect.invoke(
+            "multi",
+            actions=[
+                AnkiConnect.request(
+                    "findNotes",
+                    query="nid:" + ",".join(
+                        str(id) for id in ids[start:start + App.ID_QUERY_SIZE]
+                    )
+                )
+                for start in range(0, len(ids), App.ID_QUERY_SIZE)
+            ]
+        )
+        for response in result:
+            App.EXISTING_IDS.update(AnkiConnect.parse(response))
 
 
 class File:
     """Class for performing script operations at the file-level."""
 
+    SCAN_RESULTS = [
+        "target_deck", "global_tags", "notes_to_add", "id_indexes",
+        "notes_to_edit", "notes_to_delete", "inline_notes_to_add",
+        "inline_id_indexes", "add_errors"
+    ]
+
     def __init__(self, filepath):
         """Perform initial file reading and attribute setting."""
         self.filename = filepath
         self.path = os.path.abspath(filepath)
+        self.directory = os.path.dirname(self.path)
         if CONFIG_DATA["Vault"] and App.VAULT_PATH_REGEXP.search(self.path):
             self.url = "obsidian://vault/{}".format(
                 App.VAULT_PATH_REGEXP.search(self.path).group()
             ).replace("\\", "/")
         else:
             self.url = ""
-        with open(self.filename, encoding='utf_8') as f:
+        with open(self.path, encoding='utf_8') as f:
             self.file = f.read()
             self.original_file = self.file
+        self.edits = list()
 
     def setup_frozen_fields_dict(self):
         self.frozen_fields_dict = {
             note_type: dict.fromkeys(fields, "")
             for note_type, fields in App.FIELDS_DICT.items()
         }
-        for match in App.FROZEN_REGEXP.finditer(self.file):
-            note_type, fields = match.group(1), match.group(2)
+        for token in self.tokens_of("frozen"):
+            note_type, fields = token.groups
             virtual_note = note_type + "\n" + fields
-            parsed_fields = Note(virtual_note).fields
+            parsed_fields = Note(virtual_note, self.directory).fields
             self.frozen_fields_dict[note_type] = parsed_fields
 
     def setup_target_deck(self):
-        result = App.DECK_REGEXP.search(self.file)
-        if result is not None:
-            self.target_deck = result.group(1)
+        result = self.tokens_of("deck")
+        if result:
+            self.target_deck = result[0].groups[0]
         else:
             self.target_deck = NOTE_DICT_TEMPLATE["deckName"]
 
     def setup_global_tags(self):
-        result = App.TAG_REGEXP.search(self.file)
-        if result is not None:
-            self.global_tags = result.group(1)
+        result = self.tokens_of("tags")
+        if result:
+            self.global_tags = result[0].groups[0]
         else:
             self.global_tags = ""
 
+    def tokens_of(self, kind):
+        """Get the tokens of this kind in the file, in order."""
+        return [token for token in self.tokens if token.kind == kind]
+
     @property
     def hash(self):
         return hashlib.sha256(self.file.encode('utf-8')).hexdigest()
 
+    def scan_results(self):
+        """Get what scan_file found that's needed afterwards.
+
+        Lets a file scanned in another process be sent back as plain
+        data, without its text.
+        """
+        results = {name: getattr(self, name) for name in self.SCAN_RESULTS}
+        results["tokens"] = [
+            token for token in self.tokens if token.kind in ("delete", "id")
+        ]
+        return results
+
     def scan_file(self):
         """Sort notes from file into adding vs editing."""
         logging.info("Scanning file " + self.filename + " for notes...")
+        self.tokens = list(tokenize(self.file))
         self.setup_frozen_fields_dict()
         self.setup_target_deck()
         self.setup_global_tags()
@@ -1251,9 +2464,10 @@ class File:
         self.notes_to_delete = list()
         self.inline_notes_to_add = list()
         self.inline_id_indexes = list()
-        for note_match in App.NOTE_REGEXP.finditer(self.file):
-            note, position = note_match.group(1), note_match.end(1)
-            parsed = Note(note).parse(
+        self.add_errors = dict()  # Notes Anki can't add, by index
+        for token in self.tokens_of("note"):
+            note, position = token.groups[0], token.group_end
+            parsed = Note(note, self.directory).parse(
                 self.target_deck,
                 url=self.url,
                 frozen_fields_dict=self.frozen_fields_dict
@@ -1263,20 +2477,11 @@ class File:
                 parsed.note["tags"] += self.global_tags.split(TAG_SEP)
                 self.notes_to_add.append(parsed.note)
                 self.id_indexes.append(position)
-            elif parsed.id not in App.EXISTING_IDS:
-                print(
-                    "Warning! Note with id ",
-                    parsed.id,
-                    " in file ",
-                    self.filename,
-                    " does not exist in Anki!"
-                )
             else:
                 self.notes_to_edit.append(parsed)
-        for inline_note_match in App.INLINE_REGEXP.finditer(self.file):
-            note = inline_note_match.group(1)
-            position = inline_note_match.end(1)
-            parsed = InlineNote(note).parse(
+        for token in self.tokens_of("inline"):
+            note, position = token.groups[0], token.group_end
+            parsed = InlineNote(note, self.directory).parse(
                 self.target_deck,
                 url=self.url,
                 frozen_fields_dict=self.frozen_fields_dict
@@ -1286,7 +2491,21 @@ class File:
                 parsed.note["tags"] += self.global_tags.split(TAG_SEP)
                 self.inline_notes_to_add.append(parsed.note)
                 self.inline_id_indexes.append(position)
-            elif parsed.id not in App.EXISTING_IDS:
+            else:
+                self.notes_to_edit.append(parsed)
+        # Finally, scan for deleting notes
+        for token in self.tokens_of("delete"):
+            self.notes_to_delete.append(
+                int(token.groups[0])
+            )
+
+    def remove_missing_notes(self):
+        """Stop editing notes whose IDs don't exist in Anki."""
+        existing = list()
+        for parsed in self.notes_to_edit:
+            if parsed.id in App.EXISTING_IDS:
+                existing.append(parsed)
+            else:
                 print(
                     "Warning! Note with id ",
                     parsed.id,
@@ -1294,13 +2513,7 @@ class File:
                     self.filename,
                     " does not exist in Anki!"
                 )
-            else:
-                self.notes_to_edit.append(parsed)
-        # Finally, scan for deleting notes
-        for match in RegexFile.EMPTY_REGEXP.finditer(self.file):
-            self.notes_to_delete.append(
-                int(match.group(1))
-            )
+        self.notes_to_edit = existing
 
     @staticmethod
     def id_to_str(id, inline=False, comment=False):
@@ -1315,44 +2528,76 @@ class File:
         return result
 
     def write_ids(self):
-        """Write the identifiers to self.file."""
+        """Queue up writing the identifiers to self.file."""
         logging.info("Writing new note IDs to file," + self.filename + "...")
-        self.file = string_insert(
-            self.file, list(
-                zip(
-                    self.id_indexes, [
-                        self.id_to_str(id, comment=CONFIG_DATA["Comment"])
-                        for id in self.note_ids[:len(self.notes_to_add)]
-                        if id is not None
-                    ]
-                )
-            ) + list(
-                zip(
-                    self.inline_id_indexes, [
-                        self.id_to_str(
-                            id, inline=True,
-                            comment=CONFIG_DATA["Comment"]
-                        )
-                        for id in self.note_ids[len(self.notes_to_add):]
-                        if id is not None
-                    ]
+        self.edits += [
+            (
+                index, index,
+                self.id_to_str(id, comment=CONFIG_DATA["Comment"])
+            )
+            for index, id in zip(
+                self.id_indexes,
+                self.note_ids[:len(self.notes_to_add)]
+            )
+            if id is not None
+        ] + [
+            (
+                index, index, self.id_to_str(
+                    id, inline=True, comment=CONFIG_DATA["Comment"]
                 )
             )
-        )
+            for index, id in zip(
+                self.inline_id_indexes,
+                self.note_ids[len(self.notes_to_add):]
+            )
+            if id is not None
+        ]
 
     def remove_empties(self):
-        """Remove empty notes from self.file."""
-        self.file = RegexFile.EMPTY_REGEXP.sub(
-            "", self.file
-        )
+        """Queue up removing empty notes from self.file."""
+        self.edits += [
+            (token.start, token.end, "")
+            for token in self.tokens_of("delete")
+        ]
+
+    def apply_edits(self):
+        """Apply all queued edits to self.file in one pass."""
+        if self.edits:
+            self.file = apply_edits(self.file, self.edits)
+            self.edits = list()
 
     def write_file(self):
         """Write to the actual os file"""
+        self.apply_edits()
         if self.file != self.original_file:
-            write_safe(self.filename, self.file)
+            write_safe(self.path, self.file)
+
+    def get_bulk_notes(self):
+        """Get (index, note) pairs for the notes to add with addNotes."""
+        return [
+            (index, note)
+            for index, note in enumerate(
+                self.notes_to_add + self.inline_notes_to_add
+            )
+            if index not in self.add_errors
+        ]
 
     def get_add_notes(self):
         """Get the AnkiConnect-formatted request to add notes."""
+        notes = self.notes_to_add + self.inline_notes_to_add
+        if CONFIG_DATA["Bulk Add"]:
+            notes = [note for _, note in self.get_bulk_notes()]
+            size = CONFIG_DATA["Bulk Add Chunk Size"]
+            return AnkiConnect.request(
+                "multi",
+                actions=[
+                    AnkiConnect.request(
+                        "addNotes",
+                        notes=notes[start:start + size]
+                    )
+                    for start in range(0, len(notes), size)
+                ]
+            )
         return AnkiConnect.request(
             "multi",
             actions=[
@@ -1360,15 +2605,73 @@ class File:
                     "addNote",
                     note=note
                 )
-                for note in self.notes_to_add + self.inline_notes_to_add
+                for note in notes
             ]
         )
+
+    def parse_add_notes(self, responses):
+        """Get the new note IDs from the responses to get_add_notes.
+
+        Notes that failed to add get an ID of None.
         """
-        return AnkiConnect.request(
-            "addNotes",
-            notes=self.notes_to_add + self.inline_notes_to_add
+        notes = self.notes_to_add + self.inline_notes_to_add
+        if not CONFIG_DATA["Bulk Add"]:
+            note_ids = list()
+            for note, response in zip(notes, responses):
+                try:
+                    note_ids.append(AnkiConnect.parse(response))
+                except Exception as e:
+                    self.warn_add_failed(note, e)
+                    note_ids.append(None)
+            return note_ids
+        note_ids = [None] * len(notes)
+        for index, error in self.add_errors.items():
+            self.warn_add_failed(notes[index], error)
+        bulk_notes = self.get_bulk_notes()
+        size = CONFIG_DATA["Bulk Add Chunk Size"]
+        for start, response in zip(
+            range(0, len(bulk_notes), size), responses
+        ):
+            chunk = bulk_notes[start:start + size]
+            try:
+                result = AnkiConnect.parse(response)
+            except Exception as e:
+                # Anki keeps the notes it could add without saying which,
+                # so retrying them could add them twice.
+                for index, note in chunk:
+                    self.add_errors[index] = e
+                    self.warn_add_failed(note, e)
+                continue
+            for (index, _), id in zip(chunk, result):
+                note_ids[index] = id
+        return note_ids
+
+    def warn_add_failed(self, note, error):
+        """Tell the user that note could not be added."""
+        print(
+            "Warning! Could not add note ",
+            json.dumps(note["fields"], ensure_ascii=False)[:100],
+            " in file ",
+            self.filename,
+            ": ",
+            error
         )
+
+    def get_failed_notes(self):
+        """Get (index, note) pairs for notes that failed to add.
+
+        Notes with a known error are left out, as retrying won't help.
         """
+        return [
+            (index, note)
+            for index, (note, id) in enumerate(
+                zip(
+                    self.notes_to_add + self.inline_notes_to_add,
+                    self.note_ids
+                )
+            )
+            if id is None and index not in self.add_errors
+        ]
 
     def get_delete_notes(self):
         """Get the AnkiConnect-formatted request to delete a note."""
@@ -1377,8 +2680,32 @@ class File:
             notes=self.notes_to_delete
         )
 
+    @staticmethod
+    def fields_changed(parsed, info):
+        """Check whether parsed has different fields to Anki's note info."""
+        current = {
+            name: field["value"]
+            for name, field in info.get("fields", dict()).items()
+        }
+        return bool(parsed.note["audio"]) or (
+            current != parsed.note["fields"]
+        )
+
     def get_update_fields(self):
-        """Get the AnkiConnect-formatted request to update fields."""
+        """Get the AnkiConnect-formatted request to update fields.
+
+        Uses the note info from request 1, so only notes whose fields
+        actually changed are updated.
+        """
+        changed = [
+            parsed
+            for parsed, info in zip(self.notes_to_edit, self.card_ids)
+            if File.fields_changed(parsed, info)
+        ]
+        logging.info(
+            "Updating fields of " + str(len(changed)) + " of " +
+            str(len(self.notes_to_edit)) + " notes in " + self.filename
+        )
         return AnkiConnect.request(
             "multi",
             actions=[
@@ -1389,7 +2716,7 @@ class File:
                         "audio": parsed.note["audio"]
                     }
                 )
-                for parsed in self.notes_to_edit
+                for parsed in changed
             ]
         )
 
@@ -1409,63 +2736,67 @@ class File:
         for info in self.card_ids:
             self.cards += info["cards"]
 
-    def get_change_decks(self):
-        """Get the AnkiConnect-formatted request to change decks."""
-        return AnkiConnect.request(
-            "changeDeck",
-            cards=self.cards,
-            deck=self.target_deck
-        )
-
-    def get_clear_tags(self):
-        """Get the AnkiConnect-formatted request to clear tags."""
-        return AnkiConnect.request(
-            "removeTags",
-            notes=[parsed.id for parsed in self.notes_to_edit],
-            tags=" ".join(self.tags)
-        )
+    def get_tag_changes(self):
+        """Get (id, tags to add, tags to remove) for notes with changed tags.
 
-    def get_add_tags(self):
-        """Get the AnkiConnect-formatted request to add tags."""
-        return AnkiConnect.request(
-            "multi",
-            actions=[
-                AnkiConnect.request(
-                    "addTags",
-                    notes=[parsed.id],
-                    tags=" ".join(parsed.note["tags"]) + " " + self.global_tags
-                )
-                for parsed in self.notes_to_edit
-            ]
-        )
+        Compares against the tags from the note info of request 1. Anki
+        treats tags case-insensitively, so the comparison does too.
+        """
+        changes = list()
+        for parsed, info in zip(self.notes_to_edit, self.card_ids):
+            wanted = (
+                " ".join(parsed.note["tags"]) + " " + self.global_tags
+            ).split()
+            current = info.get("tags", list())
+            wanted_keys = {tag.lower() for tag in wanted}
+            current_keys = {tag.lower() for tag in current}
+            to_add = sorted(
+                {tag for tag in wanted if tag.lower() not in current_keys}
+            )
+            to_remove = sorted(
+                {tag for tag in current if tag.lower() not in wanted_keys}
+            )
+            if to_add or to_remove:
+                changes.append((parsed.id, to_add, to_remove))
+        return changes
 
 
 class RegexFile(File):
 
+    SCAN_RESULTS = [
+        "target_deck", "global_tags", "notes_to_add", "id_indexes",
+        "notes_to_edit", "notes_to_delete", "inline_notes_to_add",
+        "add_errors"
+    ]
+
     def add_spans_to_ignore(self):
         """Mark sections of the file as places not to expect a note."""
-        self.ignore_spans += spans(App.NOTE_REGEXP, self.file)
-        self.ignore_spans += spans(App.INLINE_REGEXP, self.file)
-        self.ignore_spans += spans(
-            FormatConverter.OBS_INLINE_MATH_REGEXP, self.file
+        self.ignore_spans.update(
+            (token.start, token.end)
+            for token in self.tokens
+            if token.kind in ("note", "inline")
         )
-        self.ignore_spans += spans(
+        self.ignore_spans.update(spans(
+            FormatConverter.OBS_INLINE_MATH_REGEXP, self.file
+        ))
+        self.ignore_spans.update(spans(
             FormatConverter.OBS_DISPLAY_MATH_REGEXP, self.file
-        )
-        self.ignore_spans += spans(
+        ))
+        self.ignore_spans.update(spans(
             FormatConverter.OBS_CODE_REGEXP, self.file
-        )
-        self.ignore_spans += spans(
+        ))
+        self.ignore_spans.update(spans(
             FormatConverter.OBS_DISPLAY_CODE_REGEXP, self.file
-        )
+        ))
 
     def scan_file(self):
         """Sort notes from file into adding vs editing."""
         logging.info("Scanning file" + self.filename + " for notes...")
+        self.tokens = list(tokenize(self.file))
         self.setup_frozen_fields_dict()
         self.setup_target_deck()
         self.setup_global_tags()
-        self.ignore_spans = list()
+        self.ignore_spans = SpanIndex()
         # The above ensures that the script won't match a RegexNote inside
         # a Note or InlineNote
         self.notes_to_add = list()
@@ -1473,80 +2804,30 @@ class RegexFile(File):
         self.notes_to_edit = list()
         self.notes_to_delete = list()
         self.inline_notes_to_add = list()  # To avoid overriding get_add_notes
+        self.add_errors = dict()
         self.add_spans_to_ignore()
-        for note_type, regexp in CONFIG_DATA["CUSTOM_REGEXPS"].items():
-            if regexp:
-                self.search(note_type, regexp)
+        for note_type, (regexp, variants) in App.CUSTOM_REGEXPS.items():
+            self.search(note_type, regexp, variants)
         # Finally, scan for deleting notes
-        for match in RegexFile.EMPTY_REGEXP.finditer(self.file):
+        for token in self.tokens_of("delete"):
             self.notes_to_delete.append(
-                int(match.group(1))
+                int(token.groups[0])
             )
 
-    def search(self, note_type, regexp):
+    def search(self, note_type, regexp, variants=()):
         """
         Search the file for regex matches of this type,
+        trying the variants with tags and an ID at each,
         ignoring matches inside ignore_spans,
         and adding any matches to ignore_spans.
         """
-        regexp_tags_id = re.compile(
-            "".join(
-                [
-                    regexp,
-                    RegexNote.TAG_REGEXP_STR,
-                    RegexNote.ID_REGEXP_STR
-                ]
-            ), flags=re.MULTILINE
-        )
-        regexp_id = re.compile(
-            regexp + RegexNote.ID_REGEXP_STR, flags=re.MULTILINE
-        )
-        regexp_tags = re.compile(
-            regexp + RegexNote.TAG_REGEXP_STR, flags=re.MULTILINE
-        )
-        regexp = re.compile(
-            regexp, flags=re.MULTILINE
-        )
-        for match in findignore(regexp_tags_id, self.file, self.ignore_spans):
-            # This note has id, so we update it
-            self.ignore_spans.append(match.span())
-            parsed = RegexNote(match, note_type, tags=True, id=True).parse(
-                self.target_deck,
-                url=self.url,
-                frozen_fields_dict=self.frozen_fields_dict
-            )
-            if parsed.id not in App.EXISTING_IDS:
-                print(
-                    "Warning! Note with id ",
-                    parsed.id,
-                    " in file ",
-                    self.filename,
-                    " does not exist in Anki!"
-                )
-            else:
-                self.notes_to_edit.append(parsed)
-        for match in findignore(regexp_id, self.file, self.ignore_spans):
-            # This note has id, so we update it
-            self.ignore_spans.append(match.span())
-            parsed = RegexNote(match, note_type, tags=False, id=True).parse(
-                self.target_deck,
-                url=self.url,
-                frozen_fields_dict=self.frozen_fields_dict
-            )
-            if parsed.id not in App.EXISTING_IDS:
-                print(
-                    "Warning! Note with id ",
-                    parsed.id,
-                    " in file ",
-                    self.filename,
-                    " does not exist in Anki!"
-                )
-            else:
-                self.notes_to_edit.append(parsed)
-        for match in findignore(regexp_tags, self.file, self.ignore_spans):
-            # This note has no id, so we add it
-            self.ignore_spans.append(match.span())
-            parsed = RegexNote(match, note_type, tags=True, id=False).parse(
+        for match in findignore(
+            regexp, self.file, self.ignore_spans, variants
+        ):
+            self.ignore_spans.add(match.span())
+            parsed = RegexNote(
+                match, note_type, base_dir=self.directory
+            ).parse(
                 self.target_deck,
                 url=self.url,
                 frozen_fields_dict=self.frozen_fields_dict
@@ -1554,22 +2835,11 @@ class RegexFile(File):
             if parsed == 1:
                 # Error code
                 continue
-            parsed.note["tags"] += self.global_tags.split(TAG_SEP)
-            self.notes_to_add.append(
-                parsed.note
-            )
-            self.id_indexes.append(match.end())
-        for match in findignore(regexp, self.file, self.ignore_spans):
-            # This note has no id, so we update it
-            self.ignore_spans.append(match.span())
-            parsed = RegexNote(match, note_type, tags=False, id=False).parse(
-                self.target_deck,
-                url=self.url,
-                frozen_fields_dict=self.frozen_fields_dict
-            )
-            if parsed == 1:
-                # Error code
+            if parsed.id is not None:
+                # This note has id, so we update it
+                self.notes_to_edit.append(parsed)
                 continue
+            # This note has no id, so we add it
             parsed.note["tags"] += self.global_tags.split(TAG_SEP)
             self.notes_to_add.append(
                 parsed.note
@@ -1577,78 +2847,195 @@ class RegexFile(File):
             self.id_indexes.append(match.end())
 
     def fix_newline_ids(self):
-        """Removes double newline then ids from self.file."""
-        double_regexp = re.compile(
-            r"(\r\n|\r|\n){2}(?:<!--)?" + ID_PREFIX + r"\d+"
-        )
-        self.file = double_regexp.sub(
-            lambda x: x.group()[1:],
-            self.file
-        )
+        """Queue up removing double newline then ids from self.file."""
+        self.edits += [
+            (token.start - 2, token.start - 1, "")
+            for token in self.tokens_of("id")
+            if self.file[token.start - 2:token.start] == "\n\n"
+        ]
 
     def write_ids(self):
-        """Write the identifiers to self.file."""
+        """Queue up writing the identifiers to self.file."""
         logging.info("Writing new note IDs to file," + self.filename + "...")
-        self.file = string_insert(
-            self.file, zip(
-                self.id_indexes, [
-                    "\n" + File.id_to_str(id, comment=CONFIG_DATA["Comment"])
-                    for id in self.note_ids
-                    if id is not None
-                ]
+        self.edits += [
+            (
+                index, index,
+                # Only start a new line if the match didn't end with one,
+                # so we don't leave a blank line before the ID.
+                ("" if self.file[index - 1:index] == "\n" else "\n")
+                + File.id_to_str(id, comment=CONFIG_DATA["Comment"])
             )
-        )
+            for index, id in zip(self.id_indexes, self.note_ids)
+            if id is not None
+        ]
         self.fix_newline_ids()
 
-    def remove_empties(self):
-        """Remove empty notes from self.file."""
-        self.file = RegexFile.EMPTY_REGEXP.sub(
-            "", self.file
-        )
+
+class VaultWalker:
+    """Finds the directories and files to scan under a root directory.
+
+    Uses os.scandir, so stat results come for free with the listing.
+    Hidden folders and anything matching the gitignore-style exclude
+    patterns are pruned before they are descended into. Symlinked folders
+    are followed, but each real folder is only visited once.
+    """
+
+    def __init__(self, root, patterns=(), recurse=True):
+        self.root = os.path.abspath(root)
+        self.recurse = recurse
+        self.rules = list()
+        for pattern in patterns:
+            negate = pattern.startswith("!")
+            if negate:
+                pattern = pattern[1:]
+            dir_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            # Like gitignore, a slash anywhere but the end anchors the
+            # pattern to the root. Otherwise it matches at any level.
+            anchored = "/" in pattern
+            pattern = pattern.lstrip("/")
+            if pattern:
+                self.rules.append(
+                    (pattern.split("/"), negate, dir_only, anchored)
+                )
+
+    @staticmethod
+    def match(parts, path_parts):
+        """Match the segments of a path against those of a glob pattern.
+
+        Like gitignore, * doesn't match across a /, but a ** segment
+        matches any number of segments, including none.
+        """
+        if not parts:
+            return not path_parts
+        if parts[0] == "**":
+            return any(
+                VaultWalker.match(parts[1:], path_parts[index:])
+                for index in range(len(path_parts) + 1)
+            )
+        return bool(path_parts) and fnmatch.fnmatch(
+            path_parts[0], parts[0]
+        ) and VaultWalker.match(parts[1:], path_parts[1:])
+
+    def ignored(self, path, is_dir):
+        """Check whether the exclude patterns exclude path."""
+        rel_parts = os.path.relpath(path, self.root).split(os.sep)
+        ignored = False
+        for parts, negate, dir_only, anchored in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if VaultWalker.match(
+                parts, rel_parts if anchored else rel_parts[-1:]
+            ):
+                ignored = not negate
+        return ignored
+
+    def walk(self):
+        """Yield (directory, {file path: stat}) for directories with notes."""
+        visited = set()
+        stack = [self.root]
+        while stack:
+            path = stack.pop()
+            try:
+                stat = os.stat(path)
+            except OSError as e:
+                logging.info("Can't stat " + path + ": " + str(e))
+                continue
+            if (stat.st_dev, stat.st_ino) in visited:
+                logging.info("Skipping " + path + ", already visited.")
+                continue
+            visited.add((stat.st_dev, stat.st_ino))
+            file_stats = dict()
+            subdirs = list()
+            with os.scandir(path) as it:
+                for entry in it:
+                    try:
+                        is_dir = entry.is_dir()
+                        if is_dir:
+                            if self.recurse and not (
+                                entry.name.startswith(".")
+                                or self.ignored(entry.path, True)
+                            ):
+                                subdirs.append(entry.path)
+                        elif entry.is_file() and os.path.splitext(
+                            entry.name
+                        )[1] in App.SUPPORTED_EXTS and not self.ignored(
+                            entry.path, False
+                        ):
+                            file_stats[entry.path] = entry.stat()
+                    except OSError as e:
+                        # e.g. a broken symlink
+                        logging.info(
+                            "Can't read " + entry.path + ": " + str(e)
+                        )
+            if file_stats:
+                yield path, file_stats
+            stack += sorted(subdirs, reverse=True)
 
 
 class Directory:
     """Class for managing a directory of files at a time."""
 
-    def __init__(self, abspath, regex=False, onefile=None):
-        """Scan directory for files."""
-        self.path = abspath
-        self.parent = os.getcwd()
+    def __init__(self, abspath, regex=False, onefile=None, file_stats=None):
+        """Scan directory for files.
+
+        Files are identified by absolute path, so this doesn't depend on
+        (or change) the working directory. file_stats can be passed in if
+        the files and their stats are already known.
+        """
+        self.path = os.path.abspath(abspath)
         if regex:
             self.file_class = RegexFile
         else:
             self.file_class = File
-        os.chdir(self.path)
         if onefile:
             # Hence, just one file to do
-            self.files = [self.file_class(onefile)]
-        else:
-            with os.scandir() as it:
-                self.files = sorted(
-                    [
-                        self.file_class(entry.path)
-                        for entry in it
-                        if entry.is_file() and os.path.splitext(
-                            entry.path
-                        )[1] in App.SUPPORTED_EXTS
-                    ], key=lambda file: [
-                        int(part) if part.isdigit() else part.lower()
-                        for part in re.split(r'(\d+)', file.filename)]
-                )
+            onefile = os.path.abspath(onefile)
+            file_stats = {onefile: os.stat(onefile)}
+        elif file_stats is None:
+            with os.scandir(self.path) as it:
+                file_stats = {
+                    entry.path: entry.stat()
+                    for entry in it
+                    if entry.is_file() and os.path.splitext(
+                        entry.path
+                    )[1] in App.SUPPORTED_EXTS
+                }
+        self.stats = dict()
         files_changed = []
-        for file in self.files:
-            if file.filename in App.FILE_HASHES and (
-                file.hash == App.FILE_HASHES[file.filename]
+        for filename in sorted(
+            file_stats, key=lambda filename: [
+                int(part) if part.isdigit() else part.lower()
+                for part in re.split(r'(\d+)', filename)]
+        ):
+            stat_key = Directory.stat_key(file_stats[filename])
+            if filename in App.FILE_HASHES and (
+                App.FILE_STATS.get(filename) == stat_key
             ):
+                # Same size and modification time as when we last scanned
+                # it, so don't even open it.
+                print("Skipping", filename, "as we've scanned it before.")
+                continue
+            file = self.file_class(filename)
+            if file.hash == App.FILE_HASHES.get(filename):
                 # Indicates we've seen this in a scan before,
                 # And that it hasn't changed.
                 # So, we don't need to do anything with it!
-                print("Skipping", file.filename, "as we've scanned it before.")
+                print("Skipping", filename, "as we've scanned it before.")
+                self.stats[filename] = stat_key
             else:
-                file.scan_file()
                 files_changed.append(file)
         self.files = files_changed
-        os.chdir(self.parent)
+
+    def scan_files(self):
+        """Scan the changed files in this directory for notes."""
+        for file in self.files:
+            file.scan_file()
+
+    @staticmethod
+    def stat_key(stat):
+        """Get the parts of a stat result that show a file has changed."""
+        return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
 
     def requests_1(self):
         """Get the 1st HTTP request for this directory."""
@@ -1674,16 +3061,6 @@ class Directory:
                 ]
             )
         )
-        logging.info("Updating fields of existing notes...")
-        requests.append(
-            AnkiConnect.request(
-                "multi",
-                actions=[
-                    file.get_update_fields()
-                    for file in self.files
-                ]
-            )
-        )
         logging.info("Removing empty notes...")
         requests.append(
             AnkiConnect.request(
@@ -1699,72 +3076,121 @@ class Directory:
             actions=requests
         )
 
-    def parse_requests_1(self, requests_1_response, tags):
+    def parse_requests_1(self, requests_1_response):
         response = requests_1_response
         notes_ids = AnkiConnect.parse(response[0])
         cards_ids = AnkiConnect.parse(response[1])
         for note_ids, file in zip(notes_ids, self.files):
-            file.note_ids = [
-                AnkiConnect.parse(response)
-                for response in AnkiConnect.parse(note_ids)
-            ]
+            file.note_ids = file.parse_add_notes(AnkiConnect.parse(note_ids))
+        if CONFIG_DATA["Bulk Add"]:
+            self.retry_failed_notes()
         for card_ids, file in zip(cards_ids, self.files):
             file.card_ids = AnkiConnect.parse(card_ids)
-        for file in self.files:
-            file.tags = tags
-        os.chdir(self.path)
         for file in self.files:
             file.get_cards()
             file.write_ids()
             logging.info("Removing empty notes for file " + file.filename)
             file.remove_empties()
             file.write_file()
-        os.chdir(self.parent)
+
+    def retry_failed_notes(self):
+        """Re-add notes that failed in bulk one at a time, for diagnostics."""
+        failed = [
+            (file, index, note)
+            for file in self.files
+            for index, note in file.get_failed_notes()
+        ]
+        if not failed:
+            return
+        logging.info("Retrying " + str(len(failed)) + " failed notes...")
+        result = AnkiConnect.invoke(
+            "multi",
+            actions=[
+                AnkiConnect.request("addNote", note=note)
+                for _, _, note in failed
+            ]
+        )
+        for (file, index, note), response in zip(failed, result):
+            try:
+                file.note_ids[index] = AnkiConnect.parse(response)
+            except Exception as e:
+                file.warn_add_failed(note, e)
 
     def requests_2(self):
         """Get 2nd big request."""
         logging.info("Forming request 2 for directory " + self.path)
         requests = list()
-        logging.info("Moving cards to target deck...")
+        logging.info("Updating fields of existing notes...")
         requests.append(
             AnkiConnect.request(
                 "multi",
                 actions=[
-                    file.get_change_decks()
+                    file.get_update_fields()
                     for file in self.files
                 ]
             )
         )
         logging.info("Replacing tags...")
-        requests.append(
+        requests += self.get_tag_requests()
+        return AnkiConnect.request(
+            "multi",
+            actions=requests
+        )
+
+    def get_tag_requests(self):
+        """Get the AnkiConnect-formatted requests to reconcile tags.
+
+        Notes needing the same tags removed (or added) share one request.
+        """
+        to_remove = collections.defaultdict(list)
+        to_add = collections.defaultdict(list)
+        for file in self.files:
+            for id, add_tags, remove_tags in file.get_tag_changes():
+                if remove_tags:
+                    to_remove[" ".join(remove_tags)].append(id)
+                if add_tags:
+                    to_add[" ".join(add_tags)].append(id)
+        return [
             AnkiConnect.request(
                 "multi",
                 actions=[
-                    file.get_clear_tags()
-                    for file in self.files
+                    AnkiConnect.request("removeTags", notes=ids, tags=tags)
+                    for tags, ids in to_remove.items()
                 ]
-            )
-        )
-        requests.append(
+            ),
             AnkiConnect.request(
                 "multi",
                 actions=[
-                    file.get_add_tags()
-                    for file in self.files
+                    AnkiConnect.request("addTags", notes=ids, tags=tags)
+                    for tags, ids in to_add.items()
                 ]
             )
-        )
-        return AnkiConnect.request(
-            "multi",
-            actions=requests
-        )
+        ]
+
+    def synced_files(self):
+        """Get the files whose new notes were all added.
+
+        Others aren't recorded as scanned, so failed notes are retried.
+        """
+        return [file for file in self.files if None not in file.note_ids]
+
+    def file_stats(self):
+        """Return a dictionary of file stats to use, taken after writing."""
+        stats = dict(self.stats)
+        for file in self.synced_files():
+            stats[file.path] = Directory.stat_key(os.stat(file.path))
+        return stats
 
     def hashes(self):
         """Return a dictionary of file hashes to use."""
-        return {file.filename: file.hash for file in self.files}
+        return {
+            file.path: file.hash
+            for file in self.synced_files()
+        }
 
 
 if __name__ == "__main__":
+    setup_logging()
     print("Attempting to connect to Anki...")
     try:
         wait_for_port(ANKI_PORT)
@@ -0,0 +1,266 @@
+"""Fixtures shared by the tests of obsidian_to_anki.py."""
+import base64
+import configparser
+import hashlib
+import itertools
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import obsidian_to_anki as ota  # noqa: E402
+
+FIELDS = {
+    "Basic": ["Front", "Back"],
+    "Cloze": ["Text", "Back Extra"],
+}
+# Set by App.gen_regexp and Config.load_syntax
+REGEXP_ATTRS = [
+    (ota.App, "NOTE_REGEXP"),
+    (ota.App, "DECK_REGEXP"),
+    (ota.App, "EMPTY_REGEXP"),
+    (ota.App, "TAG_REGEXP"),
+    (ota.App, "INLINE_REGEXP"),
+    (ota.App, "INLINE_EMPTY_REGEXP"),
+    (ota.App, "VAULT_PATH_REGEXP"),
+    (ota.App, "FROZEN_REGEXP"),
+    (ota.RegexFile, "EMPTY_REGEXP"),
+]
+
+
+@pytest.fixture
+def ota_config(monkeypatch):
+    """Load the default config into fresh globals, restored afterwards.
+
+    Returns the obsidian_to_anki module.
+    """
+    for owner, name in REGEXP_ATTRS:
+        monkeypatch.setattr(owner, name, None, raising=False)
+    monkeypatch.setattr(ota, "CONFIG_DATA", dict())
+    monkeypatch.setattr(
+        ota, "NOTE_DICT_TEMPLATE", dict(ota.NOTE_DICT_TEMPLATE)
+    )
+    monkeypatch.setattr(ota, "MEDIA", dict())
+    monkeypatch.setattr(ota.App, "FIELDS_DICT", dict(FIELDS), raising=False)
+    monkeypatch.setattr(ota.App, "CUSTOM_REGEXPS", dict())
+    monkeypatch.setattr(ota.App, "MEDIA_LEDGER", dict(), raising=False)
+    monkeypatch.setattr(ota.App, "FILE_HASHES", dict(), raising=False)
+    monkeypatch.setattr(ota.App, "FILE_STATS", dict(), raising=False)
+    monkeypatch.setattr(ota.App, "NOTE_TYPES", list(), raising=False)
+    monkeypatch.setattr(ota.FormatConverter, "BACKEND", None)
+    monkeypatch.setattr(ota.FormatConverter, "CACHE", None)
+    monkeypatch.setattr(ota.AnkiConnect, "TRANSPORT", None)
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    ota.Config.setup_syntax(config)
+    ota.Config.setup_defaults(config)
+    ota.Config.load_syntax(config)
+    ota.Config.load_defaults(config)
+    ota.App.gen_regexp()
+    return ota
+
+
+class FakeAnki:
+    """An in-memory stand-in for AnkiConnect, used as its transport.
+
+    Keeps notes, cards and media like Anki would, and records the body of
+    each request sent and each action done, with its params. With remote,
+    it can't read media by path, like an Anki on another machine. With
+    legacy, addNotes gives null for each failure, like older AnkiConnect,
+    instead of failing as a whole after adding the rest.
+    """
+
+    def __init__(self, models=None, remote=False, legacy=False):
+        self.models = {
+            name: {"id": index + 1, "fields": list(fields)}
+            for index, (name, fields) in enumerate(
+                (models or FIELDS).items()
+            )
+        }
+        self.remote = remote
+        self.legacy = legacy
+        self.notes = dict()
+        self.cards = dict()
+        self.media = dict()
+        self.ids = itertools.count(1000)
+        self.bodies = list()
+        self.actions = list()
+        self.params = list()
+
+    def send(self, body):
+        self.bodies.append(body)
+        return json.dumps(self.do(json.loads(body))).encode('utf-8')
+
+    def do(self, request):
+        self.actions.append(request["action"])
+        self.params.append(request.get("params", dict()))
+        try:
+            result = getattr(self, request["action"])(
+                **request.get("params", dict())
+            )
+        except Exception as e:
+            return {"result": None, "error": str(e)}
+        return {"result": result, "error": None}
+
+    def sent(self, action):
+        """Count how many times action was done."""
+        return self.actions.count(action)
+
+    def calls(self, action):
+        """Get the params action was done with, each time."""
+        return [
+            params
+            for done, params in zip(self.actions, self.params)
+            if done == action
+        ]
+
+    def forget(self):
+        """Forget the requests so far."""
+        del self.bodies[:], self.actions[:], self.params[:]
+
+    def multi(self, actions):
+        return [self.do(action) for action in actions]
+
+    def version(self):
+        return 6
+
+    def modelNames(self):
+        return list(self.models)
+
+    def modelNamesAndIds(self):
+        return {name: model["id"] for name, model in self.models.items()}
+
+    def modelFieldNames(self, modelName):
+        if modelName not in self.models:
+            raise Exception("model was not found: " + modelName)
+        return list(self.models[modelName]["fields"])
+
+    def findNotes(self, query):
+        ids = [int(id) for id in query[len("nid:"):].split(",") if id]
+        return [id for id in ids if id in self.notes]
+
+    def notesInfo(self, notes):
+        return [
+            {
+                "noteId": id,
+                "modelName": self.notes[id]["modelName"],
+                "tags": list(self.notes[id]["tags"]),
+                "fields": {
+                    name: {"value": value, "order": order}
+                    for order, (name, value) in enumerate(
+                        self.notes[id]["fields"].items()
+                    )
+                },
+                "cards": list(self.notes[id]["cards"]),
+            } if id in self.notes else dict()
+            for id in notes
+        ]
+
+    def check_note(self, note):
+        if not any(value.strip() for value in note["fields"].values()):
+            raise Exception("cannot create note because it is empty")
+        for id, other in self.notes.items():
+            if other["modelName"] == note["modelName"] and list(
+                other["fields"].values()
+            )[0] == list(note["fields"].values())[0] and self.cards[
+                other["cards"][0]
+            ]["deck"] == note["deckName"]:
+                raise Exception(
+                    "cannot create note because it is a duplicate"
+                )
+
+    def canAddNotesWithErrorDetail(self, notes):
+        if self.legacy:
+            raise Exception("unsupported action")
+        result = list()
+        for note in notes:
+            try:
+                self.check_note(note)
+            except Exception as e:
+                result.append({"canAdd": False, "error": str(e)})
+            else:
+                result.append({"canAdd": True})
+        return result
+
+    def addNote(self, note):
+        self.check_note(note)
+        id, card = next(self.ids), next(self.ids)
+        self.notes[id] = {
+            "modelName": note["modelName"],
+            "fields": dict(note["fields"]),
+            "tags": [tag for tag in note["tags"] if tag],
+            "cards": [card],
+        }
+        self.cards[card] = {"note": id, "deck": note["deckName"]}
+        return id
+
+    def addNotes(self, notes):
+        ids, errors = list(), list()
+        for note in notes:
+            try:
+                ids.append(self.addNote(note))
+            except Exception as e:
+                ids.append(None)
+                errors.append(str(e))
+        if errors and not self.legacy:
+            raise Exception(str(errors))
+        return ids
+
+    def updateNoteFields(self, note):
+        self.notes[note["id"]]["fields"].update(note["fields"])
+
+    def deleteNotes(self, notes):
+        for id in notes:
+            for card in self.notes.pop(id)["cards"]:
+                del self.cards[card]
+
+    def getDecks(self, cards):
+        decks = dict()
+        for card in cards:
+            decks.setdefault(self.cards[card]["deck"], list()).append(card)
+        return decks
+
+    def changeDeck(self, cards, deck):
+        for card in cards:
+            self.cards[card]["deck"] = deck
+
+    def addTags(self, notes, tags):
+        for id in notes:
+            for tag in tags.split():
+                if tag not in self.notes[id]["tags"]:
+                    self.notes[id]["tags"].append(tag)
+
+    def removeTags(self, notes, tags):
+        for id in notes:
+            self.notes[id]["tags"] = [
+                tag for tag in self.notes[id]["tags"]
+                if tag not in tags.split()
+            ]
+
+    def storeMediaFile(self, filename, data=None, path=None, skipHash=None,
+                       deleteExisting=True):
+        if data is not None:
+            contents = base64.b64decode(data)
+        elif self.remote:
+            raise Exception("No such file or directory: " + path)
+        else:
+            with open(path, "rb") as f:
+                contents = f.read()
+        if skipHash == hashlib.md5(contents).hexdigest():
+            return None
+        self.media[filename] = contents
+        return filename
+
+    def deleteMediaFile(self, filename):
+        self.media.pop(filename, None)
+
+
+@pytest.fixture
+def anki(ota_config, monkeypatch):
+    """Talk to a FakeAnki instead of AnkiConnect."""
+    fake = FakeAnki()
+    monkeypatch.setattr(ota_config.AnkiConnect, "TRANSPORT", fake)
+    return fake
@@ -0,0 +1,360 @@
+"""Check the requests obsidian_to_anki.py sends, against a fake AnkiConnect.
+
+Syncs a small vault with App, as the script would, with FakeAnki as
+AnkiConnect.TRANSPORT, and checks only what changed is sent.
+"""
+import configparser
+import json
+import os
+import sys
+
+import pytest
+
+import obsidian_to_anki as ota
+from conftest import FakeAnki
+
+NOTES = (
+    "TARGET DECK: Deck\n\n"
+    "START\nBasic\nFirst\nBack: one\nTags: a b\nEND\n\n"
+    "START\nBasic\nSecond\nBack: two\nTags: a\nEND\n"
+)
+
+
+def note_ids(anki):
+    return sorted(anki.notes)
+
+
+@pytest.fixture
+def sync(anki, tmp_path, monkeypatch):
+    """Sync the vault in tmp_path, with the given config overrides."""
+    monkeypatch.setattr(ota, "CONFIG_PATH", str(tmp_path / "config.ini"))
+    monkeypatch.setattr(ota, "DATA_PATH", str(tmp_path / "data.json"))
+    monkeypatch.setattr(
+        ota, "FORMAT_CACHE_PATH", str(tmp_path / "cache.json")
+    )
+    (tmp_path / "vault").mkdir()
+
+    def run(regexps=None, **defaults):
+        config = configparser.ConfigParser()
+        config.optionxform = str
+        config["Custom Regexps"] = {note_type: "" for note_type in anki.models}
+        config["Custom Regexps"].update(regexps or dict())
+        ota.Config.setup_syntax(config)
+        ota.Config.setup_defaults(config)
+        config["Defaults"]["GUI"] = "False"
+        config["Defaults"].update(defaults)
+        with open(ota.CONFIG_PATH, "w", encoding="utf_8") as f:
+            config.write(f)
+        monkeypatch.setattr(
+            sys, "argv", ["obsidian_to_anki.py", str(tmp_path / "vault")]
+        )
+        ota.MEDIA.clear()
+        anki.forget()
+        ota.App()
+    return run
+
+
+def write(tmp_path, name, text):
+    path = tmp_path / "vault" / name
+    path.write_text(text, encoding="utf_8")
+    return path
+
+
+def edit(path, old, new):
+    text = path.read_text(encoding="utf_8")
+    assert old in text
+    path.write_text(text.replace(old, new), encoding="utf_8")
+
+
+@pytest.mark.parametrize("max_bytes, max_actions", [
+    (10 ** 6, 3), (200, 10 ** 6), (1, 1)
+])
+def test_batches_match_one_multi(anki, max_bytes, max_actions):
+    ota.CONFIG_DATA["Batch Max Bytes"] = max_bytes
+    ota.CONFIG_DATA["Batch Max Actions"] = max_actions
+    request = ota.AnkiConnect.request
+    actions = [
+        request("version"),
+        request("multi", actions=[
+            request("modelFieldNames", modelName=note_type)
+            for note_type in ["Basic", "Missing", "Cloze"] * 2
+        ]),
+        request("modelNames"),
+        request("multi", actions=[
+            request("multi", actions=[request("version")] * 3),
+            request("modelNamesAndIds"),
+        ]),
+        request("modelFieldNames", modelName="Missing"),
+    ]
+    expected = FakeAnki().multi(actions)
+    assert ota.AnkiConnect.invoke_batched(actions) == expected
+    assert len(anki.bodies) > 1
+    for body in anki.bodies:
+        if max_bytes > 1:
+            assert len(body) <= max_bytes
+        assert ota.RequestBatcher.count_actions(
+            json.loads(body)
+        ) <= max_actions
+
+
+def test_new_notes_are_added_with_ids(sync, anki, tmp_path):
+    path = write(tmp_path, "notes.md", NOTES)
+    sync()
+    assert anki.sent("addNote") == 2
+    assert len(anki.notes) == 2
+    text = path.read_text(encoding="utf_8")
+    for id in note_ids(anki):
+        assert "ID: " + str(id) in text
+    assert [card["deck"] for card in anki.cards.values()] == ["Deck"] * 2
+
+
+@pytest.fixture
+def opened(monkeypatch):
+    """List the paths of the files read, by File."""
+    paths = list()
+    init = ota.File.__init__
+
+    def counting_init(self, filepath):
+        paths.append(filepath)
+        init(self, filepath)
+    monkeypatch.setattr(ota.File, "__init__", counting_init)
+    return paths
+
+
+def test_unchanged_stat_skips_reading(sync, tmp_path, opened):
+    write(tmp_path, "notes.md", NOTES)
+    sync()
+    assert len(opened) == 1
+    sync()
+    assert len(opened) == 1
+
+
+def test_touched_file_only_updates_stat(sync, anki, tmp_path, opened):
+    path = write(tmp_path, "notes.md", NOTES)
+    sync()
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    sync()
+    assert len(opened) == 2
+    assert set(anki.actions) == {
+        "multi", "version", "modelNames", "modelFieldNames"
+    }
+    with open(ota.DATA_PATH) as f:
+        (stats,) = json.load(f)["File Stats"].values()
+    assert stats[2] == stat.st_mtime_ns + 10 ** 9
+    sync()
+    assert len(opened) == 2
+
+
+def add_existing(anki, front):
+    return anki.addNote({
+        "modelName": "Basic", "deckName": "Deck", "tags": [],
+        "fields": {"Front": front, "Back": ""}
+    })
+
+
+@pytest.mark.parametrize("legacy", [False, True])
+def test_bulk_add_skips_notes_anki_cant_add(sync, anki, tmp_path, capsys,
+                                            legacy):
+    anki.legacy = legacy
+    existing = add_existing(anki, "Existing")
+    path = write(tmp_path, "notes.md", NOTES + (
+        "\nSTART\nBasic\nExisting\nBack: again\nEND\n"
+    ))
+    sync(**{"Bulk Add": "True"})
+    assert len(anki.notes) == 3
+    text = path.read_text(encoding="utf_8")
+    for id in note_ids(anki):
+        assert ("ID: " + str(id) in text) == (id != existing)
+    assert text.count("ID: ") == 2
+    assert "duplicate" in capsys.readouterr().out
+    # Only notes that failed without an error are retried, to get one
+    assert anki.sent("addNote") == (1 if legacy else 0)
+
+
+def test_bulk_add_skips_duplicates_of_new_notes(sync, anki, tmp_path,
+                                                capsys):
+    path = write(tmp_path, "notes.md", NOTES + (
+        "\nSTART\nBasic\nFirst\nBack: again\nEND\n"
+    ))
+    sync(**{"Bulk Add": "True"})
+    assert anki.calls("addNotes")[0]["notes"][-1]["fields"]["Back"] == "two"
+    assert len(anki.notes) == 2
+    assert path.read_text(encoding="utf_8").count("ID: ") == 2
+    assert "duplicate of another new note" in capsys.readouterr().out
+
+
+def test_bulk_add_does_not_retry_failed_chunks(sync, anki, tmp_path,
+                                               monkeypatch, capsys):
+    def unsupported(notes):
+        raise Exception("unsupported action")
+    monkeypatch.setattr(anki, "canAddNotesWithErrorDetail", unsupported)
+    add_existing(anki, "Existing")
+    path = write(tmp_path, "notes.md", NOTES + (
+        "\nSTART\nBasic\nExisting\nBack: again\nEND\n"
+    ))
+    sync(**{"Bulk Add": "True", "Bulk Add Chunk Size": "1"})
+    assert anki.sent("addNotes") == 3
+    assert anki.sent("addNote") == 0
+    assert len(anki.notes) == 3
+    assert path.read_text(encoding="utf_8").count("ID: ") == 2
+    assert "duplicate" in capsys.readouterr().out
+
+
+def test_bulk_add_regex_notes(sync, anki, tmp_path):
+    path = write(tmp_path, "notes.md", "Q: one\nA: 1\n\nQ: two\nA: 2\n")
+    sync(
+        regexps={"Basic": r"^Q: (.*)\nA: (.*)"},
+        **{"Regex": "True", "Bulk Add": "True"}
+    )
+    assert anki.sent("addNotes") == 1
+    assert path.read_text(encoding="utf_8").count("ID: ") == 2
+
+
+@pytest.mark.parametrize("bulk", ["False", "True"])
+def test_failed_notes_are_retried_next_sync(sync, anki, tmp_path, bulk):
+    existing = add_existing(anki, "Existing")
+    path = write(tmp_path, "notes.md", NOTES + (
+        "\nSTART\nBasic\nExisting\nBack: again\nEND\n"
+    ))
+    sync(**{"Bulk Add": bulk})
+    assert path.read_text(encoding="utf_8").count("ID: ") == 2
+    anki.deleteNotes([existing])
+    sync(**{"Bulk Add": bulk})
+    assert path.read_text(encoding="utf_8").count("ID: ") == 3
+    assert len(anki.notes) == 3
+
+
+def test_only_changed_fields_are_updated(sync, anki, tmp_path):
+    path = write(tmp_path, "notes.md", NOTES)
+    sync()
+    first, second = note_ids(anki)
+    edit(path, "Back: two", "Back: three")
+    sync()
+    assert anki.sent("addNote") == 0
+    (update,) = anki.calls("updateNoteFields")
+    assert update["note"]["id"] == second
+    assert anki.notes[second]["fields"]["Back"] == "three"
+
+
+def test_unchanged_file_sends_no_edits(sync, anki, tmp_path):
+    write(tmp_path, "notes.md", NOTES)
+    sync()
+    sync()
+    for action in [
+        "addNote", "updateNoteFields", "addTags", "removeTags", "changeDeck"
+    ]:
+        assert anki.sent(action) == 0, action
+
+
+def test_only_changed_tags_are_sent(sync, anki, tmp_path):
+    path = write(tmp_path, "notes.md", NOTES)
+    sync()
+    first, second = note_ids(anki)
+    edit(path, "Tags: a b\n", "Tags: a c\n")
+    sync()
+    assert anki.calls("removeTags") == [{"notes": [first], "tags": "b"}]
+    assert anki.calls("addTags") == [{"notes": [first], "tags": "c"}]
+    assert anki.sent("updateNoteFields") == 0
+    assert sorted(anki.notes[first]["tags"]) == [
+        "Obsidian_to_Anki", "a", "c"
+    ]
+
+
+def test_only_moved_cards_change_deck(sync, anki, tmp_path):
+    path = write(tmp_path, "notes.md", NOTES)
+    sync()
+    first, second = note_ids(anki)
+    (moved,) = anki.notes[second]["cards"]
+    anki.changeDeck([moved], "Elsewhere")
+    edit(path, "Back: one", "Back: edited")
+    sync()
+    assert anki.calls("changeDeck") == [{"cards": [moved], "deck": "Deck"}]
+    assert anki.cards[moved]["deck"] == "Deck"
+
+
+def test_id_check_is_scoped_to_file(sync, anki, tmp_path, capsys):
+    other = anki.addNote({
+        "modelName": "Basic", "deckName": "Deck", "tags": [],
+        "fields": {"Front": "Not in the vault", "Back": ""}
+    })
+    path = write(tmp_path, "notes.md", NOTES)
+    sync()
+    first, second = note_ids(anki)[1:]
+    edit(path, "ID: " + str(second), "ID: 999")
+    edit(path, "Back: one", "Back: edited")
+    sync()
+    (find,) = anki.calls("findNotes")
+    assert find == {"query": "nid:999,{}".format(first)}
+    assert str(other) not in find["query"]
+    assert anki.sent("notesInfo") == 1
+    assert [
+        update["note"]["id"] for update in anki.calls("updateNoteFields")
+    ] == [first]
+    assert "999" in capsys.readouterr().out
+
+
+def media_notes(tmp_path, count):
+    for index in range(count):
+        (tmp_path / "vault" / "{}.png".format(index)).write_bytes(
+            bytes([index]) * 100
+        )
+    return write(tmp_path, "media.md", "".join(
+        "START\nBasic\nImage {0}\nBack: ![]({0}.png)\nEND\n\n".format(index)
+        for index in range(count)
+    ))
+
+
+def stored(anki):
+    return [
+        params for params in anki.calls("storeMediaFile")
+        if params["filename"] != "_obsidian_to_anki_probe.txt"
+    ]
+
+
+def test_media_sent_by_path(sync, anki, tmp_path):
+    media_notes(tmp_path, 2)
+    sync()
+    assert sorted(params["filename"] for params in stored(anki)) == [
+        "0.png", "1.png"
+    ]
+    assert all("data" not in params for params in stored(anki))
+    assert anki.media["1.png"] == bytes([1]) * 100
+
+
+def test_media_falls_back_to_base64(sync, anki, tmp_path):
+    anki.remote = True
+    media_notes(tmp_path, 2)
+    sync()
+    assert all(
+        "path" not in params and "data" in params
+        for params in stored(anki)
+    )
+    assert sorted(anki.media) == ["0.png", "1.png"]
+
+
+def test_media_upload_option(sync, anki, tmp_path):
+    media_notes(tmp_path, 1)
+    sync(**{"Media Upload": "base64"})
+    assert anki.calls("storeMediaFile") == stored(anki)  # No probe
+    assert "data" in stored(anki)[0]
+
+
+def test_media_is_batched(sync, anki, tmp_path):
+    media_notes(tmp_path, 3)
+    sync(**{"Media Upload": "base64", "Media Batch Max Bytes": "300"})
+    batches = [
+        body for body in anki.bodies if b'"storeMediaFile"' in body
+    ]
+    assert len(batches) == 2  # Two files of 136 bytes encoded, then one
+    assert sorted(anki.media) == ["0.png", "1.png", "2.png"]
+
+
+def test_media_is_sent_once(sync, anki, tmp_path):
+    path = media_notes(tmp_path, 2)
+    sync(**{"Media Upload": "base64"})
+    edit(path, "Image 0", "Image zero")
+    (tmp_path / "vault" / "1.png").write_bytes(b"edited")
+    sync(**{"Media Upload": "base64"})
+    assert [params["filename"] for params in stored(anki)] == ["1.png"]
+    assert anki.media["1.png"] == b"edited"
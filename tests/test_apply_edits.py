@@ -0,0 +1,44 @@
+"""Check apply_edits makes all its edits to a string in one pass."""
+import pytest
+
+from obsidian_to_anki import apply_edits
+
+
+@pytest.mark.parametrize("edits, expected", [
+    ([], "abcdef"),
+    ([(0, 0, "X")], "Xabcdef"),
+    ([(6, 6, "X")], "abcdefX"),
+    ([(1, 3, "")], "adef"),
+    ([(1, 3, "XYZ")], "aXYZdef"),
+    # Indices are into the original string, whatever the order
+    ([(4, 4, "Y"), (0, 2, ""), (2, 2, "X")], "XcdYef"),
+    # Inserts at the same place keep their sorted order
+    ([(2, 2, "Y"), (2, 2, "X")], "abXYcdef"),
+    # An insert where a deletion starts or ends is kept
+    ([(1, 4, ""), (1, 1, "X"), (4, 4, "Y")], "aXYef"),
+    # Touching deletions
+    ([(1, 3, ""), (3, 5, "")], "af"),
+])
+def test_apply_edits(edits, expected):
+    assert apply_edits("abcdef", edits) == expected
+
+
+@pytest.mark.parametrize("edits, expected", [
+    # An insert inside a deletion
+    ([(1, 4, ""), (2, 2, "X")], "aef"),
+    # A deletion starting inside another
+    ([(1, 4, ""), (3, 5, "Y")], "aef"),
+    # A deletion inside a replacement
+    ([(0, 5, "X"), (1, 2, "")], "Xf"),
+])
+def test_edit_starting_inside_earlier_edit_is_dropped(edits, expected):
+    assert apply_edits("abcdef", edits) == expected
+
+
+def test_matches_edits_made_one_at_a_time():
+    string = "START\nBasic\nfront\nEND\n\n\nID: 1\nSTART\nEND\n"
+    edits = [(22, 23, ""), (21, 21, "ID: 2\n"), (30, 40, "")]
+    expected = string
+    for start, end, replacement in sorted(edits, reverse=True):
+        expected = expected[:start] + replacement + expected[end:]
+    assert apply_edits(string, edits) == expected
@@ -0,0 +1,119 @@
+"""Check FormatCache stores formatted fields, and evicts the oldest."""
+import json
+
+import pytest
+
+import obsidian_to_anki as ota
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "cache.json")
+
+
+def entry(size):
+    return ["x" * size, list()]
+
+
+def test_key(path):
+    cache = ota.FormatCache(path, 1000)
+    key = cache.key("text", False)
+    assert key == ota.FormatCache(path, 1000).key("text", False)
+    assert key != cache.key("text", True)
+    assert key != cache.key("other", False)
+    assert key != ota.FormatCache(
+        path, 1000, backend="markdown-it"
+    ).key("text", False)
+
+
+def test_key_changes_with_library_version(path, monkeypatch):
+    import markdown
+    key = ota.FormatCache(path, 1000).key("text", False)
+    monkeypatch.setattr(markdown, "__version__", "0.0.1")
+    assert ota.FormatCache(path, 1000).key("text", False) != key
+
+
+def test_unknown_backend_falls_back_to_markdown(path):
+    assert ota.FormatCache(
+        path, 1000, backend="unknown"
+    ).key("text", False) == ota.FormatCache(path, 1000).key("text", False)
+
+
+def test_get_and_put(path):
+    cache = ota.FormatCache(path, 1000)
+    assert cache.get("a") is None
+    cache.put("a", ["<p>a</p>", ["a.png"]])
+    assert cache.get("a") == ["<p>a</p>", ["a.png"]]
+
+
+def test_save_and_load(path):
+    cache = ota.FormatCache(path, 1000)
+    cache.put("a", ["<p>a</p>", ["a.png"]])
+    cache.save()
+    loaded = ota.FormatCache(path, 1000)
+    loaded.load()
+    assert loaded.get("a") == ["<p>a</p>", ["a.png"]]
+
+
+@pytest.mark.parametrize("contents", ["", "{not json", "[1, 2"])
+def test_unreadable_cache_starts_empty(path, contents):
+    with open(path, "w") as f:
+        f.write(contents)
+    cache = ota.FormatCache(path, 1000)
+    cache.load()
+    assert cache.entries == dict()
+
+
+def test_missing_cache_starts_empty(path):
+    cache = ota.FormatCache(path, 1000)
+    cache.load()
+    assert cache.entries == dict()
+
+
+def test_save_evicts_least_recently_used(path):
+    cache = ota.FormatCache(path, 250)
+    for key in "abc":
+        cache.put(key, entry(100))
+    cache.get("a")  # So b is now the least recently used
+    cache.save()
+    assert list(cache.entries) == ["c", "a"]
+    with open(path) as f:
+        assert list(json.load(f)) == ["c", "a"]
+
+
+def test_save_replaces_file(path, tmp_path):
+    cache = ota.FormatCache(path, 1000)
+    cache.put("a", entry(1))
+    cache.save()
+    cache.put("b", entry(1))
+    cache.save()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["cache.json"]
+
+
+def test_take_added_and_update(path):
+    worker = ota.FormatCache(path, 1000)
+    worker.put("a", entry(1))
+    assert worker.take_added() == {"a": entry(1)}
+    assert worker.take_added() == dict()
+    cache = ota.FormatCache(path, 1000)
+    cache.update({"a": entry(1)})
+    assert cache.get("a") == entry(1)
+
+
+def test_format_uses_cache(ota_config, path, monkeypatch):
+    rendered = list()
+    render = ota.FormatConverter.render
+
+    def counting_render(note_text, cloze=False):
+        rendered.append(note_text)
+        return render(note_text, cloze)
+    monkeypatch.setattr(
+        ota.FormatConverter, "render", staticmethod(counting_render)
+    )
+    ota.FormatConverter.CACHE = ota.FormatCache(path, 1000)
+    first = ota.FormatConverter.format("**bold**")
+    assert ota.FormatConverter.format("**bold**") == first
+    assert first == "<strong>bold</strong>"
+    assert rendered == ["**bold**"]
+    ota.FormatConverter.format("**bold**", cloze=True)
+    assert rendered == ["**bold**", "**bold**"]
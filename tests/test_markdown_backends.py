@@ -0,0 +1,107 @@
+"""Check the Markdown backends of obsidian_to_anki.py render notes alike.
+
+Scans every file in the test vault suites with each backend, using the
+custom regexps saved with the suite, and compares the formatted fields
+against the default Python-Markdown backend. Suites whose notes only the
+plugin finds are formatted as a whole instead.
+"""
+import glob
+import json
+import os
+import re
+
+import pytest
+
+import obsidian_to_anki as ota
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SUITES = os.path.join(ROOT, 'tests', 'defaults', 'test_vault_suites')
+SETTINGS = os.path.join(
+    '.obsidian', 'plugins', 'obsidian-to-anki-plugin', 'data.json'
+)
+# CommonMark ends a paragraph at a line holding an HTML comment,
+# while Python-Markdown keeps it inside the paragraph.
+KNOWN_DRIFT = {
+    "markdown-it": {"ng_basic_update", "ng_delete_sync"},
+}
+# Needs the plugin's highlights to clozes
+PLUGIN_ONLY = {"cloze_highlight"}
+
+
+@pytest.fixture
+def suite_config(ota_config):
+    """Set up the config a suite was saved with."""
+    def setup(suite):
+        settings = dict()
+        path = os.path.join(SUITES, suite, SETTINGS)
+        if os.path.exists(path):
+            with open(path, encoding='utf_8') as f:
+                settings = json.load(f)["settings"]
+        ota.CONFIG_DATA["CurlyCloze"] = settings.get(
+            "Defaults", dict()
+        ).get("CurlyCloze", True)
+        ota.CONFIG_DATA["CUSTOM_REGEXPS"] = settings.get(
+            "CUSTOM_REGEXPS", dict()
+        )
+        ota.App.gen_custom_regexps()
+    return setup
+
+
+def render(backend, suite):
+    """Scan the files of a suite with backend, getting (path, fields)."""
+    ota.FormatConverter.BACKEND = ota.MARKDOWN_BACKENDS[backend]()
+    ota.MEDIA.clear()
+    notes = list()
+    for path in sorted(glob.glob(
+        os.path.join(SUITES, suite, '**', '*.md'), recursive=True
+    )):
+        if suite in PLUGIN_ONLY:
+            with open(path, encoding='utf_8') as f:
+                text = f.read()
+            notes.append((path, {"Text": ota.FormatConverter.format(
+                text, base_dir=os.path.dirname(path)
+            )}))
+            continue
+        for file_class in (ota.File, ota.RegexFile):
+            file = file_class(path)
+            file.scan_file()
+            notes += [
+                (path, note["fields"])
+                for note in file.notes_to_add + file.inline_notes_to_add
+            ]
+            notes += [
+                (path, parsed.note["fields"])
+                for parsed in file.notes_to_edit
+            ]
+    return notes
+
+
+def normalise(fields):
+    """Ignore whitespace next to tags, which doesn't change the card."""
+    return {
+        name: re.sub(r"\s*(<[^>]*>)\s*", r"\1", value)
+        for name, value in fields.items()
+    }
+
+
+@pytest.mark.parametrize("suite", sorted(os.listdir(SUITES)))
+def test_suite_has_notes(suite_config, suite):
+    suite_config(suite)
+    assert render("markdown", suite)
+
+
+@pytest.mark.parametrize("backend", sorted(
+    set(ota.MARKDOWN_BACKENDS) - {"markdown"}
+))
+@pytest.mark.parametrize("suite", sorted(os.listdir(SUITES)))
+def test_backend_matches_default(suite_config, backend, suite):
+    if backend == "markdown-it":
+        pytest.importorskip("markdown_it")
+    if suite in KNOWN_DRIFT.get(backend, set()):
+        pytest.xfail("known difference from Python-Markdown")
+    suite_config(suite)
+    expected = render("markdown", suite)
+    actual = render(backend, suite)
+    assert len(actual) == len(expected)
+    for (path, want), (_, got) in zip(expected, actual):
+        assert normalise(got) == normalise(want), path
@@ -0,0 +1,49 @@
+"""Check FormatConverter masks math and code, and puts them back intact."""
+import re
+
+import pytest
+
+import obsidian_to_anki as ota
+
+pytestmark = pytest.mark.usefixtures("ota_config")
+
+
+def test_mask_and_unmask():
+    matches = list()
+    masked = ota.FormatConverter.mask(
+        "a `b` c `d`", re.compile(r"`[^`]*`"), "P", matches
+    )
+    assert masked == "a P0Z c P1Z"
+    assert matches == ["`b`", "`d`"]
+    assert ota.FormatConverter.unmask(masked, "P", matches) == "a `b` c `d`"
+
+
+def test_unmask_escapes():
+    assert ota.FormatConverter.unmask(
+        "P0Z", "P", ["a < b"], escape=True
+    ) == "a &lt; b"
+
+
+def test_unmask_nested_placeholders():
+    assert ota.FormatConverter.unmask(
+        "P1Z", "P", ["`x`", "```\nuse P0Z\n```"]
+    ) == "```\nuse `x`\n```"
+
+
+@pytest.mark.parametrize("text", [
+    "OBSTOANKIMATH0Z", "OBSTOANKICODE0Z", "OBSTOANKIXMATH1Z"
+])
+def test_placeholder_like_text_is_left_alone(text):
+    assert ota.FormatConverter.mask_prefix(text) not in text
+    assert ota.FormatConverter.format(
+        text + " $x^2$ and `c`"
+    ) == text + r" \(x^2\) and <code>c</code>"
+
+
+def test_inline_code_in_code_block():
+    assert ota.FormatConverter.format(
+        "```\nuse `x` here\n```"
+    ) == "<pre><code>use `x` here\n</code></pre>"
+    assert ota.FormatConverter.format(
+        "before `a` ```\n`b` inside\n``` after"
+    ) == "before <code>a</code> <code>`b` inside</code> after"
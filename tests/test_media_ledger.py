@@ -0,0 +1,235 @@
+"""Check the media ledger only sends new or changed media, by name."""
+import os
+
+import pytest
+
+
+@pytest.fixture
+def ota(ota_config, monkeypatch):
+    """Count the files hashed, in ota.HASHED."""
+    hashed = list()
+    file_hash = ota_config.file_hash
+
+    def counting_file_hash(path):
+        hashed.append(path)
+        return file_hash(path)
+    monkeypatch.setattr(ota_config, "file_hash", counting_file_hash)
+    monkeypatch.setattr(ota_config, "HASHED", hashed, raising=False)
+    return ota_config
+
+
+def write(path, contents):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(contents)
+    return str(path)
+
+
+def sync(ota):
+    """Record MEDIA as sent, like App does after a sync."""
+    ota.App.MEDIA_LEDGER.update(ota.MEDIA)
+    ota.MEDIA.clear()
+    del ota.HASHED[:]
+
+
+def test_new_media_is_sent_once(ota, tmp_path):
+    path = write(tmp_path / "img.png", b"one")
+    assert ota.FormatConverter.media_filename(path) == "img.png"
+    assert ota.MEDIA["img.png"]["path"] == path
+    sync(ota)
+    assert ota.FormatConverter.media_filename(path) == "img.png"
+    assert ota.MEDIA == {}
+    assert ota.HASHED == []  # Same stat, so not even read
+
+
+def test_edited_media_is_sent_again(ota, tmp_path):
+    path = write(tmp_path / "img.png", b"one")
+    ota.FormatConverter.media_filename(path)
+    sync(ota)
+    write(tmp_path / "img.png", b"edited")
+    assert ota.FormatConverter.media_filename(path) == "img.png"
+    assert list(ota.MEDIA) == ["img.png"]
+
+
+def test_touched_media_is_not_sent(ota, tmp_path):
+    path = write(tmp_path / "img.png", b"one")
+    ota.FormatConverter.media_filename(path)
+    sync(ota)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert ota.FormatConverter.media_filename(path) == "img.png"
+    assert ota.MEDIA == {}
+    assert ota.App.MEDIA_LEDGER["img.png"]["stat"][2] == (
+        stat.st_mtime_ns + 10 ** 9
+    )
+
+
+def test_same_basename_different_contents(ota, tmp_path):
+    first = write(tmp_path / "a" / "img.png", b"one")
+    second = write(tmp_path / "b" / "img.png", b"two")
+    assert ota.FormatConverter.media_filename(first) == "img.png"
+    renamed = ota.FormatConverter.media_filename(second)
+    assert renamed.startswith("img-") and renamed.endswith(".png")
+    assert sorted(ota.MEDIA) == sorted(["img.png", renamed])
+    sync(ota)
+    # Stable across syncs
+    assert ota.FormatConverter.media_filename(second) == renamed
+    assert ota.MEDIA == {}
+
+
+def test_same_basename_same_contents(ota, tmp_path):
+    first = write(tmp_path / "a" / "img.png", b"one")
+    second = write(tmp_path / "b" / "img.png", b"one")
+    ota.FormatConverter.media_filename(first)
+    sync(ota)
+    assert ota.FormatConverter.media_filename(second) == "img.png"
+    assert ota.MEDIA == {}
+
+
+def test_renamed_media_in_html(ota, tmp_path):
+    write(tmp_path / "a" / "img.png", b"one")
+    write(tmp_path / "b" / "img.png", b"two")
+    write(tmp_path / "b" / "song.mp3", b"la")
+    first = ota.FormatConverter.format(
+        "![](img.png)", base_dir=str(tmp_path / "a")
+    )
+    second = ota.FormatConverter.format(
+        "![](img.png) ![](http://example.com/img.png) [sound:song.mp3]",
+        base_dir=str(tmp_path / "b")
+    )
+    (renamed,) = set(ota.MEDIA) - {"img.png", "song.mp3"}
+    assert 'src="img.png"' in first
+    assert 'src="' + renamed + '"' in second
+    assert 'src="http://example.com/img.png"' in second
+    assert "[sound:song.mp3]" in second
+
+
+def test_legacy_media_is_adopted(ota, tmp_path):
+    path = write(tmp_path / "img.png", b"one")
+    ota.App.MEDIA_LEDGER["img.png"] = {
+        "hash": None, "path": None, "stat": None
+    }
+    assert ota.FormatConverter.media_filename(path) == "img.png"
+    assert ota.MEDIA == {}
+    assert ota.App.MEDIA_LEDGER["img.png"]["path"] == path
+
+
+def test_missing_media_keeps_its_name(ota, tmp_path, capsys):
+    first = write(tmp_path / "a" / "img.png", b"one")
+    second = write(tmp_path / "b" / "img.png", b"two")
+    ota.FormatConverter.media_filename(first)
+    renamed = ota.FormatConverter.media_filename(second)
+    sync(ota)
+    os.remove(second)
+    assert ota.FormatConverter.media_filename(second) == renamed
+    assert ota.FormatConverter.media_filename(
+        str(tmp_path / "c" / "new.png")
+    ) == "new.png"
+    assert ota.MEDIA == {}
+    assert "Warning! Couldn't read media" in capsys.readouterr().out
+
+
+def test_find_changed_media(ota, tmp_path):
+    path = write(tmp_path / "img.png", b"one")
+    gone = write(tmp_path / "gone.png", b"gone")
+    ota.FormatConverter.media_filename(path)
+    ota.FormatConverter.media_filename(gone)
+    sync(ota)
+    os.remove(gone)
+    ota.App.find_changed_media()
+    assert ota.MEDIA == {}
+    write(tmp_path / "img.png", b"edited")
+    ota.App.find_changed_media()
+    assert list(ota.MEDIA) == ["img.png"]
+
+
+@pytest.mark.parametrize("jobs", [1, 3])
+def test_parallel_scan_names_media_like_one_process(ota, tmp_path, jobs):
+    directories = list()
+    for name in ["p1", "p2", "p3"]:
+        write(tmp_path / name / "img.png", name.encode())
+        (tmp_path / name / "note.md").write_text(
+            "START\nBasic\nfront " + name + " ![](img.png)\n"
+            "Back: back\nEND\n"
+        )
+        directories.append(ota.Directory(str(tmp_path / name)))
+    ota.App.scan_directories(None, directories, jobs)
+    fronts = [
+        file.notes_to_add[0]["fields"]["Front"]
+        for directory in directories
+        for file in directory.files
+    ]
+    assert 'src="img.png"' in fronts[0]
+    names = [front.split('src="')[1].split('"')[0] for front in fronts]
+    assert len(set(names)) == 3
+    assert {
+        name: entry["path"] for name, entry in ota.MEDIA.items()
+    } == {
+        name: str(tmp_path / "p{}".format(i + 1) / "img.png")
+        for i, name in enumerate(names)
+    }
+
+
+def parallel_vault(ota, tmp_path):
+    """Three directories with a note and an image each."""
+    directories = list()
+    for name in ["p1", "p2", "p3"]:
+        write(tmp_path / name / (name + ".png"), name.encode())
+        (tmp_path / name / "note.md").write_text(
+            "START\nBasic\nfront ![](" + name + ".png)\nBack: back\nEND\n"
+        )
+        directories.append(ota.Directory(str(tmp_path / name)))
+    return directories
+
+
+@pytest.mark.parametrize("jobs", [1, 3])
+def test_parallel_scan_updates_ledger(ota, tmp_path, jobs):
+    for name in ["p1", "p2"]:
+        # Sent before the ledger kept hashes
+        ota.App.MEDIA_LEDGER[name + ".png"] = {
+            "hash": None, "path": None, "stat": None
+        }
+    ota.App.scan_directories(None, parallel_vault(ota, tmp_path), jobs)
+    sync(ota)
+    path = str(tmp_path / "p3" / "p3.png")
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    ota.App.scan_directories(None, parallel_vault(ota, tmp_path), jobs)
+    assert ota.MEDIA == {}
+    for name in ["p1", "p2", "p3"]:
+        entry = ota.App.MEDIA_LEDGER[name + ".png"]
+        assert entry["path"] == str(tmp_path / name / (name + ".png"))
+        assert entry["hash"] is not None
+        assert entry["stat"] == ota.Directory.stat_key(
+            os.stat(entry["path"])
+        )
+
+
+def test_scan_job_sends_back_plain_results(ota, tmp_path):
+    (directory,) = parallel_vault(ota, tmp_path)[:1]
+    (file,) = directory.files
+    scanned, media, ledger, formatted = ota.scan_file_job(file)
+    assert set(scanned) == set(ota.File.SCAN_RESULTS) | {"tokens"}
+    assert [token.kind for token in scanned["tokens"]] == []
+    assert list(media) == ["p1.png"]
+
+
+@pytest.mark.parametrize("jobs", [1, 3])
+def test_parallel_scan_adopts_legacy_media_once(ota, tmp_path, jobs):
+    ota.App.MEDIA_LEDGER["img.png"] = {
+        "hash": None, "path": None, "stat": None
+    }
+    directories = list()
+    for name in ["p1", "p2"]:
+        write(tmp_path / name / "img.png", name.encode())
+        (tmp_path / name / "note.md").write_text(
+            "START\nBasic\nfront ![](img.png)\nBack: back\nEND\n"
+        )
+        directories.append(ota.Directory(str(tmp_path / name)))
+    ota.App.scan_directories(None, directories, jobs)
+    assert ota.App.MEDIA_LEDGER["img.png"]["path"] == str(
+        tmp_path / "p1" / "img.png"
+    )
+    (renamed,) = ota.MEDIA
+    assert renamed.startswith("img-")
+    front = directories[1].files[0].notes_to_add[0]["fields"]["Front"]
+    assert 'src="' + renamed + '"' in front
@@ -0,0 +1,68 @@
+"""Check the fields of note types are fetched with the startup request."""
+import pytest
+
+import obsidian_to_anki as ota
+
+
+@pytest.fixture
+def app(anki):
+    """An App that hasn't run, to call methods on."""
+    return ota.App.__new__(ota.App)
+
+
+def bootstrap(anki, app, refresh=False):
+    """Bootstrap, returning the number of requests it took."""
+    sent = len(anki.bodies)
+    app.bootstrap(refresh=refresh)
+    return len(anki.bodies) - sent
+
+
+def test_first_run_fetches_fields(anki, app):
+    assert bootstrap(anki, app) == 2
+    assert ota.App.FIELDS_DICT == {
+        "Basic": ["Front", "Back"],
+        "Cloze": ["Text", "Back Extra"],
+    }
+    assert ota.App.NOTE_TYPES == ["Basic", "Cloze"]
+
+
+def test_known_note_types_take_one_request(anki, app):
+    bootstrap(anki, app)
+    assert bootstrap(anki, app) == 1
+    assert ota.App.FIELDS_DICT["Basic"] == ["Front", "Back"]
+
+
+def test_renamed_field(anki, app):
+    bootstrap(anki, app)
+    anki.models["Basic"]["fields"] = ["Front", "Answer"]
+    assert bootstrap(anki, app) == 1
+    assert ota.App.FIELDS_DICT["Basic"] == ["Front", "Answer"]
+
+
+def test_new_and_removed_note_types(anki, app):
+    bootstrap(anki, app)
+    anki.models["Reversed"] = {"id": 3, "fields": ["Front", "Back"]}
+    del anki.models["Cloze"]
+    assert bootstrap(anki, app) == 2
+    assert ota.App.FIELDS_DICT == {
+        "Basic": ["Front", "Back"],
+        "Reversed": ["Front", "Back"],
+    }
+    assert ota.App.NOTE_TYPES == ["Basic", "Reversed"]
+
+
+def test_refresh_fetches_everything(anki, app):
+    bootstrap(anki, app)
+    actions = len(anki.actions)
+    assert bootstrap(anki, app, refresh=True) == 2
+    assert anki.actions[actions:].count("modelFieldNames") == 2
+
+
+def test_old_data_file(ota_config, tmp_path, monkeypatch):
+    path = tmp_path / "data.json"
+    path.write_text(
+        '{"Note Types": {"Basic": {"id": 1, "fields": ["Front"]}}}'
+    )
+    monkeypatch.setattr(ota, "DATA_PATH", str(path))
+    ota.Data.load_data_file()
+    assert ota.App.NOTE_TYPES == ["Basic"]
@@ -0,0 +1,94 @@
+"""Check custom regexps find notes with their tags and IDs."""
+import pytest
+
+import obsidian_to_anki as ota
+
+# A greedy Q/A regexp, whose answer runs on over any following lines
+# that aren't an ID comment.
+QA_REGEXP = (
+    r"^Q: ((?:.+\n)*)\n*A: "
+    r"(.+(?:\n(?:^.{1,3}$|^.{4}(?<!<!--).*))*)"
+)
+
+
+@pytest.fixture
+def scan(ota_config, tmp_path):
+    """Scan text as a file with regexp for Basic notes."""
+    ota = ota_config
+
+    def scan(text, comment=False, regexp=QA_REGEXP):
+        ota.CONFIG_DATA["Comment"] = comment
+        ota.CONFIG_DATA["CUSTOM_REGEXPS"] = {"Basic": regexp}
+        ota.App.gen_custom_regexps()
+        path = tmp_path / "notes.md"
+        path.write_text(text, encoding="utf_8")
+        file = ota.RegexFile(str(path))
+        file.scan_file()
+        return file
+    return scan
+
+
+@pytest.mark.parametrize("comment", [False, True])
+def test_greedy_regexp_leaves_id_line(scan, comment):
+    id_line = "<!--ID: 1000-->" if comment else "ID: 1000"
+    file = scan(
+        "Q: q1\nA: a1\n" + id_line + "\n\nQ: q2\nA: a2\n", comment
+    )
+    assert [note.id for note in file.notes_to_edit] == [1000]
+    assert file.notes_to_edit[0].note["fields"] == {
+        "Front": "q1", "Back": "a1"
+    }
+    assert [note["fields"] for note in file.notes_to_add] == [
+        {"Front": "q2", "Back": "a2"}
+    ]
+
+
+def test_greedy_regexp_runs_into_next_note(scan):
+    file = scan("Q: q1\nA: a1\nID: 1000\nQ: q2\nA: a2\n")
+    (note,) = file.notes_to_edit
+    assert note.id == 1000
+    assert note.note["fields"] == {"Front": "q1", "Back": "a1"}
+    assert [note["fields"] for note in file.notes_to_add] == [
+        {"Front": "q2", "Back": "a2"}
+    ]
+
+
+def test_one_search_per_note_type(scan, monkeypatch):
+    searched = list()
+    findignore = ota.findignore
+
+    def counting_findignore(pattern, *args):
+        searched.append(pattern)
+        return findignore(pattern, *args)
+    monkeypatch.setattr(ota, "findignore", counting_findignore)
+    scan("Q: q1\nA: a1\nTags: x\nID: 1000\n\nQ: q2\nA: a2\n")
+    assert len(searched) == 1
+
+
+def test_tags_and_id(scan):
+    file = scan(
+        "Q: q1\nA: a1\nTags: x y\nID: 1000\n\nQ: q2\nA: a2\nTags: z\n",
+        regexp=r"^Q: (.*)\nA: (.*)\n"
+    )
+    (note,) = file.notes_to_edit
+    assert note.id == 1000
+    assert note.note["fields"] == {"Front": "q1", "Back": "a1"}
+    assert note.note["tags"][-2:] == ["x", "y"]
+    (note,) = file.notes_to_add
+    assert note["fields"] == {"Front": "q2", "Back": "a2"}
+    assert "z" in note["tags"]
+
+
+def test_second_scan_edits_written_ids(scan):
+    text = "Q: q1\nA: a1\n\nQ: q2\nA: a2\n"
+    file = scan(text)
+    assert len(file.notes_to_add) == 2
+    file.note_ids = [1000, 1001]
+    file.write_ids()
+    file.apply_edits()
+    file = scan(file.file)
+    assert [note.id for note in file.notes_to_edit] == [1000, 1001]
+    assert [note.note["fields"]["Back"] for note in file.notes_to_edit] == [
+        "a1", "a2"
+    ]
+    assert file.notes_to_add == []
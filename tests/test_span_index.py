@@ -0,0 +1,66 @@
+"""Check SpanIndex agrees with a linear scan of its spans."""
+import random
+
+import pytest
+
+from obsidian_to_anki import SpanIndex
+
+
+def contained_in(span, spans, leeway=1):
+    """The linear scan SpanIndex replaced."""
+    return any(
+        span[0] >= start - leeway and span[1] <= end + leeway
+        for start, end in spans
+    )
+
+
+def random_spans(rng, count, size=200):
+    spans = list()
+    for _ in range(count):
+        start = rng.randrange(size)
+        spans.append((start, start + rng.randrange(20)))
+    return spans
+
+
+def test_empty():
+    assert not SpanIndex().contains((0, 0))
+
+
+@pytest.mark.parametrize("span, expected", [
+    ((10, 20), True),
+    ((12, 18), True),
+    ((9, 21), True),  # Within the leeway
+    ((8, 20), False),
+    ((10, 22), False),
+    ((25, 50), True),  # Inside the later of two overlapping spans
+    ((18, 32), False),  # Across them, without either containing it
+    ((60, 61), False),
+])
+def test_contains(span, expected):
+    index = SpanIndex([(30, 55), (10, 20), (25, 50)])
+    assert index.contains(span) == expected
+
+
+def test_nested_spans_are_dropped():
+    index = SpanIndex([(5, 8), (0, 10), (2, 3), (20, 30), (0, 10)])
+    assert list(zip(index.starts, index.ends)) == [(0, 10), (20, 30)]
+    index.add((15, 40))
+    assert list(zip(index.starts, index.ends)) == [(0, 10), (15, 40)]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_matches_linear_scan(seed):
+    rng = random.Random(seed)
+    spans = list()
+    index = SpanIndex()
+    for _ in range(5):
+        added = random_spans(rng, 10)
+        spans += added
+        index.update(added)
+        assert index.starts == sorted(index.starts)
+        assert index.ends == sorted(index.ends)
+        for span in random_spans(rng, 50):
+            for leeway in (0, 1):
+                assert index.contains(span, leeway) == contained_in(
+                    span, spans, leeway
+                ), (span, spans)
@@ -0,0 +1,52 @@
+"""Benchmark the start-up of obsidian_to_anki.py, to catch regressions.
+
+Importing the script should stay quick, since it runs on every sync, so
+heavy modules are only imported once they're needed.
+"""
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["markdown", "gooey", "wx", "webbrowser", "subprocess"]
+# Generous, so slow machines pass, but well under the time it took to
+# import everything eagerly.
+IMPORT_BUDGET = 0.5
+RUNS = 5
+
+MEASURE = """
+import json, sys, time
+start = time.perf_counter()
+import obsidian_to_anki
+print(json.dumps({
+    "seconds": time.perf_counter() - start,
+    "modules": sorted(set(sys.argv[1:]) & set(sys.modules)),
+}))
+"""
+
+
+def measure(tmp_path):
+    """Import the script in a fresh interpreter, returning the results."""
+    output = subprocess.run(
+        [sys.executable, "-c", MEASURE] + HEAVY_MODULES,
+        cwd=str(tmp_path),
+        env=dict(os.environ, PYTHONPATH=ROOT),
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout
+    return json.loads(output.decode().splitlines()[-1])
+
+
+def test_heavy_modules_not_imported(tmp_path):
+    assert measure(tmp_path)["modules"] == []
+
+
+def test_import_time(tmp_path):
+    best = min(measure(tmp_path)["seconds"] for _ in range(RUNS))
+    assert best < IMPORT_BUDGET, "Import took {:.3f}s".format(best)
+
+
+def test_import_leaves_no_log(tmp_path):
+    measure(tmp_path)
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,89 @@
+"""Check tokenize finds the same syntax as running each regexp over a file."""
+import random
+import re
+
+import pytest
+
+import obsidian_to_anki as ota
+
+FRAGMENTS = [
+    "START", "END", "ENDx", "STARTI", " ENDI",
+    "STARTI a ENDI b STARTI c ENDI", "Basic", "Back: x", "Q: a", "x", "",
+    "TARGET DECK", "TARGET DECK: d", "FILE TAGS: t", "FILE TAGS",
+    "FROZEN - Basic:", "FROZEN - T: FROZEN - U:",
+    "DELETE", "DELETE\n", "DELETE ID: 5", "ID: 12", "<!--ID: 7-->",
+    "ID: 3 DELETE",
+]
+
+pytestmark = pytest.mark.usefixtures("ota_config")
+
+
+def first_directives(tokens):
+    """Drop all but the first deck and tags, the only ones used."""
+    seen = set()
+    for token in tokens:
+        if token[0] in ("deck", "tags"):
+            if token[0] in seen:
+                continue
+            seen.add(token[0])
+        yield token
+
+
+def expected_tokens(string):
+    """Get (kind, start, end, groups) for every regexp's matches."""
+    regexps = [
+        ("id", re.compile(r"^" + ota.Note.ID_REGEXP.pattern, re.M)),
+        ("deck", ota.App.DECK_REGEXP),
+        ("tags", ota.App.TAG_REGEXP),
+        ("frozen", ota.App.FROZEN_REGEXP),
+        ("note", ota.App.NOTE_REGEXP),
+        ("inline", ota.App.INLINE_REGEXP),
+        ("delete", ota.RegexFile.EMPTY_REGEXP),
+    ]
+    return sorted(first_directives(
+        (kind, match.start(), match.end(), match.groups())
+        for kind, regexp in regexps
+        for match in regexp.finditer(string)
+    ))
+
+
+def tokens(string):
+    return sorted(first_directives(
+        (token.kind, token.start, token.end, token.groups)
+        for token in ota.tokenize(string)
+    ))
+
+
+def test_file():
+    string = (
+        "TARGET DECK: Deck\nFILE TAGS: a b\n\n"
+        "START\nBasic\nFront\nBack: back\nID: 1\nEND\n\n"
+        "STARTI [Basic] inline Back: back ENDI\n"
+        "FROZEN - Basic:\nfrozen\n\n"
+        "DELETE\n<!--ID: 2-->\n"
+    )
+    assert [token.kind for token in ota.tokenize(string)] == [
+        "deck", "tags", "note", "id", "inline", "frozen", "delete", "id"
+    ]
+    note = next(
+        token for token in ota.tokenize(string) if token.kind == "note"
+    )
+    assert note.groups == ("Basic\nFront\nBack: back\nID: 1\n",)
+    assert string[note.start:note.end].startswith("START\n")
+    assert note.group_end == string.index("END\n\nSTARTI")
+
+
+def test_group_end():
+    (token,) = ota.tokenize("ID: 123 trailing")
+    assert token.kind == "id"
+    assert token.group_end == len("ID: 123")
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_matches_regexps(seed):
+    rng = random.Random(seed)
+    for _ in range(200):
+        string = "\n".join(
+            rng.choice(FRAGMENTS) for _ in range(rng.randrange(15))
+        ) + rng.choice(["", "\n"])
+        assert tokens(string) == expected_tokens(string), string
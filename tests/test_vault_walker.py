@@ -0,0 +1,100 @@
+"""Check VaultWalker finds notes, and excludes like gitignore."""
+import os
+
+import pytest
+
+import obsidian_to_anki as ota
+
+TREE = [
+    "top.md",
+    "build/a.md",
+    "notes/build/b.md",
+    "notes/deep/c.md",
+    "notes/draft.md",
+    "notes/keep.md",
+    "notes/deep/draft.md",
+    "archive/2020/d.md",
+    "archive/e.md",
+    ".hidden/f.md",
+    "image.png",
+]
+
+
+@pytest.fixture
+def vault(tmp_path):
+    for path in TREE:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text("")
+    return tmp_path
+
+
+def walk(vault, patterns, recurse=True):
+    """Get the relative paths of the files found, with / separators."""
+    return sorted(
+        os.path.relpath(path, str(vault)).replace(os.sep, "/")
+        for _, file_stats in ota.VaultWalker(
+            str(vault), patterns=patterns, recurse=recurse
+        ).walk()
+        for path in file_stats
+    )
+
+
+def test_no_patterns(vault):
+    assert walk(vault, []) == sorted(
+        path for path in TREE
+        if path.endswith(".md") and not path.startswith(".")
+    )
+
+
+def test_no_recurse(vault):
+    assert walk(vault, [], recurse=False) == ["top.md"]
+
+
+def test_unanchored_dir_matches_at_any_level(vault):
+    assert "build/a.md" not in walk(vault, ["build/"])
+    assert "notes/build/b.md" not in walk(vault, ["build/"])
+
+
+def test_anchored_dir_only_matches_at_root(vault):
+    found = walk(vault, ["/build/"])
+    assert "build/a.md" not in found
+    assert "notes/build/b.md" in found
+
+
+def test_dir_only_skips_files(vault):
+    (vault / "file.md").mkdir()
+    (vault / "file.md" / "g.md").write_text("")
+    found = walk(vault, ["*.md/"])
+    assert "file.md/g.md" not in found
+    assert "top.md" in found
+
+
+def test_star_doesnt_cross_slash(vault):
+    found = walk(vault, ["notes/*.md"])
+    assert "notes/draft.md" not in found
+    assert "notes/keep.md" not in found
+    assert "notes/deep/c.md" in found
+    assert "notes/deep/draft.md" in found
+
+
+def test_double_star(vault):
+    found = walk(vault, ["**/draft.md"])
+    assert "notes/draft.md" not in found
+    assert "notes/deep/draft.md" not in found
+    found = walk(vault, ["archive/**/*.md"])
+    assert "archive/e.md" not in found
+    assert "archive/2020/d.md" not in found
+    assert "top.md" in found
+
+
+def test_unanchored_file_pattern(vault):
+    found = walk(vault, ["draft.md"])
+    assert "notes/draft.md" not in found
+    assert "notes/deep/draft.md" not in found
+    assert "notes/keep.md" in found
+
+
+def test_negation(vault):
+    found = walk(vault, ["notes/*.md", "!keep.md"])
+    assert "notes/draft.md" not in found
+    assert "notes/keep.md" in found